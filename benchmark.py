@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import re
+import time
+import tracemalloc
+
+from src import demacro
+from src.FigureScanner import FigureScanner
+from src.MainFileResolver import MainFileResolver
+from src.PaperManifest import PaperManifest
+
+
+def bench_mainfile(args):
+    """
+    Compare the first-\\documentclass-hit rule with the ranked resolver over a
+    subject directory of extracted papers. With --labels ({id: main file
+    relative to the paper directory}) accuracy is measured against them,
+    otherwise a pick counts as correct if it has \\begin{document}.
+    """
+    labels = {}
+    if args.labels:
+        with open(args.labels, "r") as file:
+            labels = json.load(file)
+
+    ids = sorted(
+        name for name in os.listdir(args.subject_path)
+        if os.path.isdir(os.path.join(args.subject_path, name))
+    )
+    start = time.perf_counter()
+    manifests = {id: PaperManifest.build(os.path.join(args.subject_path, id), []) for id in ids}
+    build_time = time.perf_counter() - start
+
+    def first_hit(id, manifest):
+        candidates = manifest.main_candidates()
+        return candidates[0] if candidates else None
+
+    def ranked(id, manifest):
+        return MainFileResolver().resolve(id, manifest)
+
+    def correct(id, manifest, pick):
+        if labels:
+            return labels.get(id) == pick
+        return pick is not None and manifest.files[pick]["begin_document"]
+
+    print(f"{len(ids)} papers, manifests built in {build_time:.3f}s")
+    for name, method in [("first hit", first_hit), ("ranked", ranked)]:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            picks = {id: method(id, manifest) for id, manifest in manifests.items()}
+        elapsed = (time.perf_counter() - start) / args.repeat
+        scored = [id for id in ids if not labels or id in labels]
+        hits = sum(correct(id, manifests[id], picks[id]) for id in scored)
+        accuracy = hits / len(scored) if scored else 0.0
+        print(f"{name:>10}: accuracy {accuracy:.2%} ({hits}/{len(scored)}), {elapsed * 1000:.2f} ms")
+
+
+def legacy_figures(tex):
+    """The nested regex path TikzFinder.find used before FigureScanner."""
+    for figure in re.findall(r"\\begin{figure\*?}(.*?)\\end{figure\*?}", tex, re.DOTALL):
+        if figure.count(r"\begin{tikzpicture}") == 1:
+            if tikz := re.search(r"(\\begin{tikzpicture}.*\\end{tikzpicture})", figure, re.DOTALL):
+                (*_, raw_caption), caption, unmatched_parens = figure.partition(r"\caption{"), "", 1
+                for c in raw_caption:
+                    if c == '}':
+                        unmatched_parens -= 1
+                    elif c == '{':
+                        unmatched_parens += 1
+                    if not unmatched_parens:
+                        break
+                    caption += c
+                if caption:
+                    yield tikz.group(1), caption
+
+
+def synthetic_document(figures):
+    """A document with figures of one, two (as subfigures) and no tikzpictures, and filler text in between."""
+    filler = "Some text with $x^2$ and a \\cite{ref}. " * 40 + "\n"
+    tikz = "\\begin{tikzpicture}\n" + "\\draw (0,0) -- (1,1) node {$a_{1}$};\n" * 20 + "\\end{tikzpicture}\n"
+    kinds = [
+        "\\begin{figure}\n\\centering\n" + tikz + "\\caption{A {nested} caption \\label{fig}}\n\\end{figure}\n",
+        "\\begin{figure*}\n" + "".join(
+            "\\begin{subfigure}{0.5\\textwidth}\n" + tikz + f"\\caption{{Part {i}}}\n\\end{{subfigure}}\n" for i in range(2)
+        ) + "\\caption{Two parts}\n\\end{figure*}\n",
+        "\\begin{figure}\n\\includegraphics{plot}\n\\caption{Not tikz}\n\\end{figure}\n",
+    ]
+    body = "".join(filler + kinds[i % len(kinds)] for i in range(figures))
+    return "\\documentclass{article}\n\\begin{document}\n" + body + "\\end{document}\n"
+
+
+def bench_figures(args):
+    """
+    Compare the nested regex figure search with the single-pass FigureScanner
+    on the given merged .tex files, or on a synthetic document.
+    """
+    documents = {}
+    for path in args.paths:
+        with open(path, "r", encoding="utf-8", errors="replace") as file:
+            documents[path] = file.read()
+    if not documents:
+        documents["synthetic"] = synthetic_document(args.synthetic)
+
+    methods = [
+        ("regex", lambda tex: list(legacy_figures(tex))),
+        ("scanner", lambda tex: list(FigureScanner(tex).pictures())),
+    ]
+    for name, tex in documents.items():
+        print(f"{name}: {len(tex) / 1024:.0f} KB")
+        for method_name, method in methods:
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                pictures = method(tex)
+            elapsed = (time.perf_counter() - start) / args.repeat
+            print(f"{method_name:>10}: {len(pictures)} tikzpictures, {elapsed * 1000:.2f} ms")
+
+
+def expand_runs(tokens):
+    """(type, value) per token, with runs of plain text split into characters."""
+    out = []
+    for token in tokens:
+        if demacro.simple_ty == token.type and 1 < len(token.val):
+            out.extend((demacro.simple_ty, c) for c in token.val)
+        else:
+            out.append((token.type, token.val))
+    return out
+
+
+def bench_tokenize(args):
+    """
+    Compare the regex tokenizer of demacro with the character by character
+    one: time them, measure the memory their token lists take and check
+    that both give the same token stream (once runs of text are split into
+    characters) on the given .tex files or on a synthetic document. Edge
+    cases are covered by tests/test_demacro.py.
+    """
+    documents = {}
+    for path in args.paths:
+        with open(path, "r", encoding="utf-8", errors="replace") as file:
+            documents[path] = file.read()
+    if not documents:
+        documents["synthetic"] = synthetic_document(args.synthetic)
+
+    methods = [("chars", demacro.tokenize_chars), ("regex", demacro.tokenize)]
+    for name, tex in documents.items():
+        print(f"{name}: {len(tex) / 1024:.0f} KB")
+        streams = {}
+        for method_name, method in methods:
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                tokens = method(tex)
+            elapsed = (time.perf_counter() - start) / args.repeat
+            del tokens
+            tracemalloc.start()
+            tokens = method(tex)
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            streams[method_name] = tokens
+            print(f"{method_name:>10}: {len(tokens)} tokens, {elapsed * 1000:.2f} ms, {size / 2**20:.1f} MB")
+        same = expand_runs(streams["regex"]) == [(token.type, token.val) for token in streams["chars"]]
+        print(f"{'':>10}  token streams {'agree' if same else 'DIFFER'}")
+
+
+def detokenize_concat(text):
+    """detokenize as it was, growing the output with +=, as a reference."""
+    out = ""
+    if 0 == len(text):
+        return
+    pos = 0
+    out += text[pos].show()
+    pos += 1
+    while pos < len(text):
+        previtem = text[pos-1]
+        item = text[pos]
+        if (demacro.esc_str_ty == previtem.type
+            and demacro.simple_ty == item.type and demacro.isletter(item.val[0])):
+            out += " "
+        out += item.show()
+        pos += 1
+    return out
+
+
+def bench_detokenize(args):
+    """
+    Time detokenizing and de-macro expansion on inputs that double in size.
+    With linear scaling the time per token stays flat from row to row.
+    """
+    unit = r"\node[draw] at (0,1) {$\vec{x}_{1}$}; \begin{wrap}{a}text \R\end{wrap} % note" + "\n"
+    table = demacro.MacroTable.from_str(
+        r"\newcommand{\vec}[1]{\mathbf{#1}}\newcommand{\R}{\mathbb{R}}"
+        r"\newenvironment{wrap}[1]{[#1}{]}"
+    )
+
+    def concat(tokens, text):
+        return detokenize_concat(list(tokens))
+
+    def join(tokens, text):
+        return demacro.detokenize(tokens)
+
+    def expand(tokens, text):
+        return demacro.TexDemacro(table=table).process(text)
+
+    print(f"{'tokens':>10} " + " ".join(f"{name:>18}" for name in ("concat ns/token", "join ns/token", "expand ns/token")))
+    for step in range(args.steps):
+        text = unit * (args.start << step)
+        tokens = demacro.tokenize(text)
+        row = []
+        for method in (concat, join, expand):
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                method(tokens, text)
+            elapsed = (time.perf_counter() - start) / args.repeat
+            row.append(elapsed / len(tokens) * 1e9)
+        print(f"{len(tokens):>10} " + " ".join(f"{ns:>18.1f}" for ns in row))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the iArxiv pipeline.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    mainfile = subparsers.add_parser("mainfile", help="Main-file detection accuracy and time.")
+    mainfile.add_argument("subject_path", help="Directory with one extracted paper per subdirectory.")
+    mainfile.add_argument("--labels", help="JSON file mapping paper id to its true main file.")
+    mainfile.add_argument("--repeat", type=int, default=5)
+    mainfile.set_defaults(func=bench_mainfile)
+
+    figures = subparsers.add_parser("figures", help="Figure and tikzpicture search time.")
+    figures.add_argument("paths", nargs="*", help="Merged .tex files; a synthetic document is used if none are given.")
+    figures.add_argument("--synthetic", type=int, default=600, help="Number of figures in the synthetic document.")
+    figures.add_argument("--repeat", type=int, default=5)
+    figures.set_defaults(func=bench_figures)
+
+    tokenize = subparsers.add_parser("tokenize", help="demacro tokenizer time and equivalence.")
+    tokenize.add_argument("paths", nargs="*", help=".tex files; a synthetic document is used if none are given.")
+    tokenize.add_argument("--synthetic", type=int, default=300, help="Number of figures in the synthetic document.")
+    tokenize.add_argument("--repeat", type=int, default=3)
+    tokenize.set_defaults(func=bench_tokenize)
+
+    detokenize = subparsers.add_parser("detokenize", help="Scaling of detokenize and de-macro expansion.")
+    detokenize.add_argument("--start", type=int, default=250, help="Repetitions of the sample line in the smallest input.")
+    detokenize.add_argument("--steps", type=int, default=6, help="Number of doublings.")
+    detokenize.add_argument("--repeat", type=int, default=3)
+    detokenize.set_defaults(func=bench_detokenize)
+
+    args = parser.parse_args()
+    args.func(args)
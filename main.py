@@ -2,12 +2,17 @@ import requests
 import feedparser
 import json
 import os
-import concurrent.futures
+import re
 from src.ArxivCollector import ArxivCollector
+from src.ArxivLister import AsyncArxivLister
+from src.CrawlState import CrawlState
+from src.EprintCache import EprintCache
 from src.LatexProcessor import LatexProcessor
+from src.AsyncFetcher import AsyncFetcher
+from src.Scheduler import Scheduler
 
 class ArxivAPI:
-    def __init__(self, dir, subject, keyword):
+    def __init__(self, dir, subject, keyword, scheduler=None):
 
         self.dir = dir
         self.keyword = keyword
@@ -19,10 +24,43 @@ class ArxivAPI:
             self.subject_path, f"{self.subject}_{self.keyword}_fit.json"
         )
         self.jsonl_file = os.path.join(self.subject_path, f"{self.subject}.jsonl")
+        # High-water mark (newest submittedDate and id) of the last listing.
+        self.listing_state_file = os.path.join(self.subject_path, f"{self.subject}_listing.json")
         self.max_results = 40
         self.start = 0
         self.sorting_method = "submittedDate"
         self.order = "descending"
+        # "feedparser" fetches listing pages one after another, "async" keeps
+        # several in flight under AsyncArxivLister's rate limiter.
+        self.listing_backend = "feedparser"
+        # Only fetch ids newer than the last listing and append them.
+        self.incremental = False
+        # Worker counts for the download -> extract -> keyword-check pipeline,
+        # and how many papers may wait between two stages.
+        self.download_workers = 8
+        self.extract_workers = 4
+        self.check_workers = 4
+        self.queue_size = 16
+        # Search the tarball for the keyword before extracting it, so papers
+        # that do not match never touch the disk.
+        self.scan_in_memory = True
+        self.scan_workers = 4
+        # "requests" fetches each e-print on a fresh connection, "async" goes
+        # through the shared keep-alive pool of AsyncFetcher.
+        self.download_backend = "requests"
+        # Processes for TikZ extraction (1 runs in-process), papers handed to
+        # a process at a time, and whether the JSONL keeps paper order.
+        self.tikz_workers = os.cpu_count() or 1
+        self.tikz_chunksize = 1
+        self.tikz_ordered = True
+        # A shared Scheduler runs the pipeline across all subjects; without
+        # one the subject runs its own pipeline right away.
+        self.scheduler = scheduler
+        # Per-paper progress shared by every subject, committed as it happens.
+        self.state = CrawlState.open(os.path.join(self.dir, "crawl_state.db"))
+        # E-prints are downloaded once into a cache shared by all subjects and
+        # hardlinked into the subject directory; None downloads per subject.
+        self.eprint_cache = EprintCache.open(os.path.join(self.dir, "eprint_cache"), max_bytes=200 << 30)
         self.on_init()
 
     def on_init(self):
@@ -33,6 +71,10 @@ class ArxivAPI:
 
         self.collect = ArxivCollector(self)
 
+        if self.scheduler is None:
+            self.on_collected()
+
+    def on_collected(self):
         self.latex_processor = LatexProcessor(self)
 
 
@@ -44,6 +86,18 @@ class ArxivAPI:
         shutil.rmtree(os.path.join(self.dir, self.subject))
 
     def get_list(self):
+        if self.incremental and os.path.isfile(self.json_file):
+            self.update_list()
+            return
+
+        if self.listing_backend == "async":
+            paper_ids = AsyncArxivLister().get_list(
+                self.query, self.max_results, self.json_file,
+                start=self.start, sorting_method=self.sorting_method, order=self.order,
+            )
+            print(f"{self.subject} finished: {len(paper_ids)} ids")
+            return
+
         start = self.start
         max_results = self.max_results
         sorting_method = self.sorting_method
@@ -62,8 +116,64 @@ class ArxivAPI:
             json.dump(paper_ids, file)
         (f"{self.subject} finished")
 
+    def update_list(self):
+        """
+        Page through the newest submissions until reaching an id that is
+        already listed, or one older than the stored high-water mark, and
+        append the new ids to the subject's JSON. Paging is not capped once
+        something is known, since the high-water mark moves up to the newest
+        id and anything left between would never be listed. Only a subject
+        with nothing listed yet stops after max_results ids. Entries pushed
+        onto the next page by new submissions are taken once.
+        """
+        with open(self.json_file, "r") as file:
+            paper_ids = json.load(file)
+        known = {self.base_id(id) for id in paper_ids}
+        state = {}
+        if os.path.isfile(self.listing_state_file):
+            with open(self.listing_state_file, "r") as file:
+                state = json.load(file)
+
+        limit = None if known or state else self.max_results
+        new_entries, seen, start, done = [], set(), 0, False
+        while not done and (limit is None or len(new_entries) < limit):
+            entries = self.search_entries(self.query, start, 40, "submittedDate", "descending")
+            if not entries:
+                break
+            for id, published in entries:
+                base_id = self.base_id(id)
+                if base_id in known or (state and published < state["newest_date"]):
+                    done = True
+                    break
+                if base_id in seen:
+                    continue
+                seen.add(base_id)
+                new_entries.append((id, published))
+            start += len(entries)
+
+        new_entries = new_entries[:limit]
+        if new_entries:
+            newest_id, newest_date = new_entries[0]
+            state = {"newest_date": newest_date, "newest_id": newest_id}
+            with open(self.listing_state_file, "w") as file:
+                json.dump(state, file)
+        paper_ids += [id for id, _ in new_entries]
+        with open(self.json_file, "w") as file:
+            json.dump(paper_ids, file)
+        print(f"{self.subject}: {len(new_entries)} new ids")
+
+    @staticmethod
+    def base_id(id):
+        """The arXiv id without its version suffix, so a new version is not a new paper."""
+        return re.sub(r"v\d+$", "", id)
+
     @staticmethod
     def search_query(query, start, max_results, sorting_method, order):
+        return [id for id, _ in ArxivAPI.search_entries(query, start, max_results, sorting_method, order)]
+
+    @staticmethod
+    def search_entries(query, start, max_results, sorting_method, order):
+        """Return (id, submission date) pairs; the ISO dates sort chronologically as strings."""
         query_terms = "query?search_query=all:" + query
         first_result = "&start=" + str(start)
         last_result = "&max_results=" + str(max_results)
@@ -79,13 +189,15 @@ class ArxivAPI:
         )
 
         if results["status"] != 200:
-            self.logger.error(f"HTTP Error {results['status']} in query")
             raise Exception("HTTP Error " + str(results["status"]) + " in query")
-        return [entry["id"].split("/")[-1] for entry in results["entries"]]
+        return [
+            (entry["id"].split("/")[-1], entry.get("published", ""))
+            for entry in results["entries"]
+        ]
 
 
-def process_subject(subject, dir, keyword):
-    api = ArxivAPI(dir=dir, subject=subject, keyword=keyword)
+def process_subject(subject, dir, keyword, scheduler=None):
+    api = ArxivAPI(dir=dir, subject=subject, keyword=keyword, scheduler=scheduler)
     # 这里可以调用 api.collect 等其他方法执行任务
 
 
@@ -100,10 +212,10 @@ if __name__ == "__main__":
     #    subjects = ['cond-mat.str-el', 'q-fin.ST', 'cs.NA', 'q-fin.PR', 'q-bio.MN', 'q-bio.BM', 'nucl-th', 'hep-ex', 'q-bio.GN', 'cs.SD', 'cs.SC', 'physics.comp-ph', 'cs.SY', 'q-bio.PE', 'stat.AP', 'gr-qc', 'cs.SE', 'q-bio.SC', 'cs.RO', 'q-fin.CP', 'stat.CO', 'math.SP', 'q-fin.RM', 'q-fin.TR', 'physics.space-ph', 'astro-ph', 'cs.IR', 'q-fin.PM', 'q-bio.NC', 'cs.AR', 'hep-th', 'cs.SI', 'stat.ML', 'stat.ME', 'q-fin.MF', 'nucl-ex', 'q-fin.GN', 'q-bio.TO', 'stat.OT', 'physics', 'hep-ph', 'q-bio.QM', 'q-fin.EC', 'stat.TH', 'q-bio.OT', 'q-bio.CB', 'math.ph', 'cs.OS', 'hep-lat', 'cs.CV']
     # subjects = ['cond-mat.dis-nn', 'cond-mat.mtrl-sci', 'cond-mat.mtrl-sci', 'cond-mat.other', 'cond-mat.quant-gas', 'cond-mat.soft', 'cond-mat.stat-mech', 'cond-mat.str-el', 'cond-mat.supr-con', 'physics.acc-ph', 'physics.app-ph', 'physics.ao-ph', 'physics.atom-ph', 'physics.atm-clus', 'physics.bio-ph', 'physics.chem-ph', 'physics.class-ph', 'physics.comp-ph', 'physics.data-an', 'physics.flu-dyn', 'physics.gen-ph', 'physics.geo-ph', 'physics.hist-ph', 'physics.ins-det', 'physics.med-ph', 'physics.optics', 'physics.ed-ph', 'physics.soc-ph', 'physics.plasm-ph', 'physics.pop-ph', 'physics.space-ph', 'math.AG','math.AT', 'math.AP', 'math.CA', 'math.CT', 'math.CO', 'math.AC',  'math.CV', 'math.DG', 'math.DS', 'math.FA', 'math.GM', 'math.GN', 'math.GT', 'math.GR', 'math.HO', 'math.IT', 'math.KT', 'math.LO', 'math.MP', 'math.MG', 'math.NT', 'math.NA', 'math.OA', 'math.OC', 'math.PR', 'math.QA', 'math.RT', 'math.RA', 'math.SP', 'math.ST', 'math.SG', 'quant-ph', 'nlin.AO', 'nlin.CG', 'nlin.CD', 'nlin.SI','nlin.PS', 'cs.AI', 'cs.CC', 'cs.CG', 'cs.CE', 'cs.CL', 'cs.CV', 'cs.CY', 'cs.CR', 'cs.DB', 'cs.DS', 'cs.DL', 'cs.DM', 'cs.DC', 'cs.ET', 'cs.FL', 'cs.GT', 'cs.GL',	'cs.GR', 'cs.AR', 'cs.HC', 'cs.IR', 'cs.IT', 'cs.LG', 'cs.LO', 'cs.MS', 'cs.MA', 'cs.MM', 'cs.NI', 'cs.NE', 'cs.NA', 'cs.OS', 'cs.OH', 'cs.PF', 'cs.PL', 'cs.RO','cs.SI', 'cs.SE', 'cs.SD', 'cs.SC', 'cs.SY', 'q-bio.BM', 'q-bio.CB', 'q-bio.GN', 'q-bio.MN', 'q-bio.NC', 'q-bio.OT', 'q-bio.PE', 'q-bio.QM', 'q-bio.SC', 'q-bio.TO','q-fin.CP', 'q-fin.EC', 'q-fin.GN', 'q-fin.MF', 'q-fin.PM', 'q-fin.PR', 'q-fin.RM', 'q-fin.ST', 'q-fin.TR', 'stat.AP', 'stat.CO', 'stat.ML', 'stat.ME', 'stat.OT', 'stat.TH', 'astro-ph', 'gr-qc', 'hep-ex', 'hep-lat', 'hep-ph', 'hep-th', 'math.ph', 'nucl-ex', 'nucl-th', 'physics']
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [
-            executor.submit(process_subject, subject, dir, keyword)
-            for subject in subjects
-        ]
-        for future in concurrent.futures.as_completed(futures):
-            future.result()  # 如果需要，可以处理返回结果或异常
+    # One scheduler for every subject: global network/disk/cpu limits instead
+    # of a thread pool per subject.
+    scheduler = Scheduler()
+    for subject in subjects:
+        process_subject(subject, dir, keyword, scheduler)
+    scheduler.run()
+    AsyncFetcher.close_shared()
@@ -1,14 +1,30 @@
 import os
+import functools
+import gzip
 import tarfile
 import shutil
 import requests
 import json
-import concurrent.futures
+import queue
+import threading
 import chardet
-import subprocess
+
+from .AsyncFetcher import AsyncFetcher, EPRINT_URL
+from .KeywordScanner import KeywordScanner
+from .PaperManifest import PaperManifest
+from .PartialDownload import PartialDownload
 
 DEBUG = False
 
+# Bytes held in memory per download; e-prints are streamed to disk in chunks.
+CHUNK_SIZE = 1 << 16
+
+# (connect, read) seconds; a stalled stream must not hold a worker forever.
+DOWNLOAD_TIMEOUT = (30, 120)
+
+# Sentinel that tells a pipeline worker its inbox is drained.
+_STOP = object()
+
 class ArxivCollector:
     def __init__(self, app):
         self.app = app
@@ -16,8 +32,14 @@ class ArxivCollector:
         self.collector_path = self.app.subject_path
         self.json_file = self.app.json_file
         self.fit_file = self.app.fit_file
+        self.state = self.app.state
         self.subject_ids = self.get_subject_ids()
-        self.get_fit_list()
+        self.todo_ids, self.resumed_ids = self.split_resumed(self.subject_ids)
+        if self.app.scheduler is None:
+            self.get_fit_list()
+        else:
+            stages = [(func, resource) for func, _, resource in self.get_stages()]
+            self.app.scheduler.add(self.todo_ids, stages, self.finish)
 
     def get_subject_ids(self):
         if os.path.isfile(self.json_file):
@@ -28,97 +50,293 @@ class ArxivCollector:
             return subject_ids
         return []
 
+    def split_resumed(self, ids):
+        """
+        Split ids into those that still need the pipeline and those a previous
+        run already finished. A paper whose keyword check failed is finished
+        (and not fit) for good; a matched paper is finished if it was
+        extracted into this subject's directory. Anything else, including
+        failed downloads and archives that could not be read, runs again.
+        """
+        rows = self.state.get(ids, self.keyword)
+        todo, resumed = [], []
+        for id in ids:
+            row = rows.get(id, {})
+            if row.get("matched") == 0:
+                continue
+            if (row.get("matched") == 1 and row.get("extracted") == 1
+                    and os.path.isdir(os.path.join(self.collector_path, id))):
+                resumed.append(id)
+            else:
+                todo.append(id)
+        if len(todo) < len(ids):
+            print(f"Resuming {self.app.subject}: {len(ids) - len(todo)} papers already done")
+        return todo, resumed
+
+    def _tracked(self, column, func):
+        """
+        Wrap a stage so its outcome is committed to the crawl state per paper.
+        A stage that returns None could not decide; nothing is recorded, so
+        the paper is tried again by the next run.
+        """
+        @functools.wraps(func)
+        def stage(id):
+            ok = func(id)
+            if ok is None:
+                return False
+            self.state.record(id, self.keyword, self.app.subject, column, ok)
+            return ok
+        return stage
+
+    def get_stages(self):
+        """Pipeline stages as (func, workers, resource) triples."""
+        download = self._tracked("downloaded", self.download_stage)
+        extract = self._tracked("extracted", self.extract_stage)
+        if self.app.scan_in_memory:
+            # Look for the keyword inside the tarball and only extract matches.
+            return [
+                (download, self.app.download_workers, "network"),
+                (self._tracked("matched", self.scan_stage), self.app.scan_workers, "cpu"),
+                (extract, self.app.extract_workers, "disk"),
+            ]
+        return [
+            (download, self.app.download_workers, "network"),
+            (extract, self.app.extract_workers, "disk"),
+            (self._tracked("matched", self.check_stage), self.app.check_workers, "cpu"),
+        ]
+
     def get_fit_list(self):
-        fit_ids = []
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            for id in self.subject_ids:
-                if executor.submit(
-                    self.download_source, self.collector_path, id
-                ).result():
-                    if executor.submit(
-                        self.tar_source, self.collector_path, id
-                    ).result():
-                        if executor.submit(
-                            self.keyword_check,
-                            os.path.join(self.collector_path, id),
-                            self.keyword,
-                        ).result():
-                            fit_ids.append(id)
-                        else:
-                            self._cleanup(id)
+        stages = [(func, workers) for func, workers, _ in self.get_stages()]
+        fit_ids = self.run_pipeline(self.todo_ids, stages)
+        self.save_fit_list(fit_ids)
 
+    def save_fit_list(self, fit_ids):
+        """Write the fit ids of this run together with the resumed ones, in listing order."""
+        fit = set(fit_ids) | set(self.resumed_ids)
         with open(self.fit_file, "w") as file:
-            json.dump(fit_ids, file)
+            json.dump([id for id in self.subject_ids if id in fit], file)
+
+    def finish(self, fit_ids):
+        """Called by the global scheduler once every paper of the subject is through."""
+        self.save_fit_list(fit_ids)
+        self.app.on_collected()
+
+    def run_pipeline(self, ids, stages):
+        """
+        Push ids through a chain of (func, workers) stages. Every stage has its
+        own worker threads and hands ids on through a bounded queue, so a slow
+        stage blocks the ones before it instead of letting tarballs pile up on
+        disk. Returns the ids that passed every stage, in their original order.
+        """
+        queues = [queue.Queue(maxsize=self.app.queue_size) for _ in stages]
+        passed = []
+        lock = threading.Lock()
+
+        def worker(func, inbox, outbox):
+            while True:
+                item = inbox.get()
+                if item is _STOP:
+                    return
+                index, id = item
+                try:
+                    ok = func(id)
+                except Exception as e:
+                    print(f"Failed {func.__name__} {id}: {e}")
+                    ok = False
+                if not ok:
+                    continue
+                if outbox is None:
+                    with lock:
+                        passed.append(item)
+                else:
+                    outbox.put(item)
+
+        groups = []
+        for i, (func, workers) in enumerate(stages):
+            outbox = queues[i + 1] if i + 1 < len(queues) else None
+            group = [
+                threading.Thread(target=worker, args=(func, queues[i], outbox), daemon=True)
+                for _ in range(max(1, workers))
+            ]
+            for thread in group:
+                thread.start()
+            groups.append(group)
+
+        for item in enumerate(ids):
+            queues[0].put(item)
+
+        # Shut the stages down front to back, so every id still in flight
+        # reaches the end of the chain before its consumers are stopped.
+        for inbox, group in zip(queues, groups):
+            for _ in group:
+                inbox.put(_STOP)
+            for thread in group:
+                thread.join()
+
+        return [id for _, id in sorted(passed)]
+
+    def download_stage(self, id):
+        if self.app.eprint_cache is not None:
+            tar_file = os.path.join(self.collector_path, f"{id}.tar.gz")
+            return self.app.eprint_cache.fetch(id, tar_file, self.fetch_source)
+        return self.fetch_source(self.collector_path, id)
+
+    def fetch_source(self, path, id):
+        if self.app.download_backend == "async":
+            return AsyncFetcher.shared().download_source(path, id)
+        return self.download_source(path, id)
+
+    def extract_stage(self, id):
+        if not self.tar_source(self.collector_path, id):
+            self._discard_eprint(id)
+            return False
+        # Walk the extracted tree once; later checks read the manifest instead.
+        manifest = PaperManifest.build(os.path.join(self.collector_path, id), [self.keyword])
+        manifest.save(PaperManifest.manifest_file(self.collector_path, id))
+        return True
+
+    def scan_stage(self, id):
+        found = self.scan_source(self.collector_path, id, self.keyword)
+        if found is None:
+            self._discard_eprint(id)
+        if not found:
+            self._cleanup(id)
+        return found
+
+    def check_stage(self, id):
+        manifest = PaperManifest.load(PaperManifest.manifest_file(self.collector_path, id))
+        if manifest.files_with(self.keyword):
+            print(f"Found {self.keyword} in a .tex file:{id}")
+            return True
+        self._cleanup(id)
+        return False
+
+    def _discard_eprint(self, id):
+        """Make the next run download an e-print that could not be read, instead of linking the cached copy."""
+        if self.app.eprint_cache is not None:
+            self.app.eprint_cache.discard(id)
 
     def _cleanup(self, id):
         if os.path.isdir(os.path.join(self.collector_path, f"{id}")):
             shutil.rmtree(os.path.join(self.collector_path, f"{id}"))
         if os.path.isfile(os.path.join(self.collector_path, f"{id}.tar.gz")) and not DEBUG:
             os.remove(os.path.join(self.collector_path, f"{id}.tar.gz"))
+        if os.path.isfile(PaperManifest.manifest_file(self.collector_path, id)):
+            os.remove(PaperManifest.manifest_file(self.collector_path, id))
 
     @staticmethod
-    def download_source(path, id):
-        url = f"https://arxiv.org/e-print/{id}"
+    def download_source(path, id, chunk_size=CHUNK_SIZE, timeout=DOWNLOAD_TIMEOUT):
+        url = EPRINT_URL + id
         tar_file = os.path.join(path, f"{id}.tar.gz")
-        response = requests.get(url)
 
-        if response.status_code == 200:
-            with open(tar_file, "wb") as file:
-                file.write(response.content)
-            return True
-        else:
-            print(f"Failed download {id}:{os.path.basename(tar_file)}")
-            return False
-
-    @staticmethod
-    def download_source(path, id):
-        url = f"https://arxiv.org/e-print/{id}"
-        tar_file = os.path.join(path, f"{id}.tar.gz")
-
-        # If tar_file exists, skip the download 
+        # If tar_file exists, skip the download. It only ever appears by
+        # renaming a finished .part file, so an existing file is complete.
         if os.path.exists(tar_file):
             print(f"{tar_file} already exists.")
             return True
 
-        response = requests.get(url)
-
-        if response.status_code == 200:
-            with open(tar_file, "wb") as file:
-                file.write(response.content)
-            return True
-        else:
-            print(f"Failed to download {id}: {os.path.basename(tar_file)}")
-            return False
+        download = PartialDownload(tar_file)
+        if download.complete():
+            return download.finish()
 
+        while True:
+            headers = download.request_headers()
+            with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                mode = download.begin(response.status_code, response.headers)
+                if mode is None:
+                    if headers:  # the server would not resume; start over once
+                        download.reset()
+                        continue
+                    print(f"Failed to download {id}: {os.path.basename(tar_file)}")
+                    return False
+                if headers and mode == "ab":
+                    print(f"Resuming {id} at byte {download.offset}")
+                # Lengths and Range offsets count the bytes as sent, so they
+                # are stored without undoing any Content-Encoding.
+                with open(download.part_file, mode) as file:
+                    for chunk in response.raw.stream(chunk_size, decode_content=False):
+                        file.write(chunk)
+            break
 
+        if download.finish():
+            return True
+        print(f"Incomplete download {id}: {os.path.basename(tar_file)}")
+        return False
 
     @staticmethod
-    def tar_source(path, id):
+    def single_file_source(tar_file):
+        """
+        The source of a single-file submission, which arXiv serves gzipped
+        rather than as a tarball: the bytes of the .tex file, empty for a
+        PDF-only submission, or None if tar_file is not gzipped at all.
+        """
+        try:
+            with gzip.open(tar_file, "rb") as file:
+                data = file.read()
+        except (OSError, EOFError):
+            return None
+        return b"" if data.startswith(b"%PDF") else data
+
+    @classmethod
+    def tar_source(cls, path, id):
         tar_file = os.path.join(path, f'{id}.tar.gz')
         untar_file = os.path.join(path, f'{id}')
 
         try:
-            with tarfile.open(tar_file) as tar:
-                tar.extractall(path=untar_file)
+            try:
+                with tarfile.open(tar_file) as tar:
+                    tar.extractall(path=untar_file)
+                return True
+            except tarfile.ReadError:
+                data = cls.single_file_source(tar_file)
+                if data is None:
+                    raise
+            os.makedirs(untar_file, exist_ok=True)
+            if data:
+                with open(os.path.join(untar_file, f"{id}.tex"), "wb") as file:
+                    file.write(data)
             return True
         except Exception as e:
-            print(f"Failed unzip {id}:{os.path.basename(tar_file)}")
+            print(f"Failed unzip {id}:{os.path.basename(tar_file)}: {e}")
             if os.path.isfile(tar_file) and not DEBUG:  # Add a condition check here
                 os.remove(tar_file)
             return False
 
+    @classmethod
+    def scan_source(cls, path, id, keyword):
+        """
+        Stream the members of the tarball and search the .tex files for the
+        keyword in memory, without extracting anything to disk. Like the
+        manifest, it skips files with a % in their name. A single-file
+        submission is searched as one .tex file. Returns None if the e-print
+        cannot be read.
+        """
+        tar_file = os.path.join(path, f'{id}.tar.gz')
+        scanner = KeywordScanner([keyword])
 
-
-
-    @staticmethod
-    def keyword_check(path, keyword):
-        command = f'grep -rl --include="*.tex" --exclude="*%*" "{keyword}" {path}'
+        members = 0
         try:
-            result = subprocess.check_output(command, shell=True)
-            if result:  # 如果找到了关键字，grep 命令会返回文件的路径
-                print(f"Found {keyword} in a .tex file:{os.path.basename(path)}")
-                return True
-            else:
+            try:
+                with tarfile.open(tar_file, mode="r|*") as tar:
+                    for member in tar:
+                        members += 1
+                        if not member.isfile() or not scanner.accepts(member.name):
+                            continue
+                        if scanner.scan_bytes(tar.extractfile(member).read()):
+                            print(f"Found {keyword} in a .tex file:{id}")
+                            return True
                 return False
-        except subprocess.CalledProcessError:
+            except tarfile.ReadError:
+                # not a tarball at all, rather than one that breaks off
+                data = cls.single_file_source(tar_file) if not members else None
+                if data is None:
+                    raise
+            if scanner.scan_bytes(data):
+                print(f"Found {keyword} in a .tex file:{id}")
+                return True
             return False
+        except Exception as e:
+            print(f"Failed unzip {id}:{os.path.basename(tar_file)}: {e}")
+            if os.path.isfile(tar_file) and not DEBUG:
+                os.remove(tar_file)
+            return None
@@ -0,0 +1,104 @@
+import asyncio
+import json
+import os
+import time
+import xml.etree.ElementTree as ET
+
+import aiohttp
+
+
+class AsyncArxivLister:
+    """
+    List the ids of a subject through export.arxiv.org/api/query with
+    several page requests in flight over one aiohttp session. A rate limiter
+    keeps request starts at least `interval` seconds apart, as the arXiv API
+    asks. Atom responses are parsed incrementally while they stream in, and
+    the ids received so far are written to the subject's JSON after every
+    page, in page order.
+    """
+    API_URL = "http://export.arxiv.org/api/query"
+    ATOM = "{http://www.w3.org/2005/Atom}"
+    OPENSEARCH = "{http://a9.com/-/spec/opensearch/1.1/}"
+
+    def __init__(self, page_size=40, concurrency=4, interval=3.0, api_url=API_URL):
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.interval = interval
+        self.api_url = api_url
+        self._next_slot = 0.0
+
+    async def _throttle(self, lock):
+        async with lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def fetch_page(self, session, lock, query, start, max_results, sorting_method, order):
+        """Return (ids, total results) for one page of the query."""
+        params = {
+            "search_query": "all:" + query,
+            "start": str(start),
+            "max_results": str(max_results),
+            "sortBy": sorting_method,
+            "sortOrder": order,
+        }
+        await self._throttle(lock)
+        parser = ET.XMLPullParser(events=("end",))
+        ids, total = [], None
+        async with session.get(self.api_url, params=params) as response:
+            if response.status != 200:
+                raise Exception("HTTP Error " + str(response.status) + " in query")
+            async for chunk in response.content.iter_chunked(1 << 14):
+                parser.feed(chunk)
+                for _, elem in parser.read_events():
+                    if elem.tag == self.ATOM + "entry":
+                        ids.append(elem.findtext(self.ATOM + "id").split("/")[-1])
+                        elem.clear()
+                    elif elem.tag == self.OPENSEARCH + "totalResults":
+                        total = int(elem.text)
+        parser.close()
+        return ids, total
+
+    @staticmethod
+    def _write(json_file, pages):
+        """Write the ids of the leading run of finished pages."""
+        paper_ids = []
+        for start in sorted(pages):
+            if pages[start] is None:
+                break
+            paper_ids += pages[start]
+        tmp_file = json_file + ".tmp"
+        with open(tmp_file, "w") as file:
+            json.dump(paper_ids, file)
+        os.replace(tmp_file, json_file)
+        return paper_ids
+
+    async def list(self, query, max_results, json_file, start=0, sorting_method="submittedDate", order="descending"):
+        lock = asyncio.Lock()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async with aiohttp.ClientSession() as session:
+
+            async def page(page_start):
+                async with semaphore:
+                    count = min(self.page_size, start + max_results - page_start)
+                    return page_start, await self.fetch_page(
+                        session, lock, query, page_start, count, sorting_method, order
+                    )
+
+            # the first page tells how many results there are to page through
+            _, (ids, total) = await page(start)
+            end = start + max_results if total is None else min(start + max_results, total)
+            pages = {start: ids}
+            pages.update({s: None for s in range(start + self.page_size, end, self.page_size)})
+            paper_ids = self._write(json_file, pages)
+
+            for next_page in asyncio.as_completed([page(s) for s in pages if pages[s] is None]):
+                page_start, (ids, _) = await next_page
+                pages[page_start] = ids
+                paper_ids = self._write(json_file, pages)
+        return paper_ids
+
+    def get_list(self, *args, **kwargs):
+        return asyncio.run(self.list(*args, **kwargs))
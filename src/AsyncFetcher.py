@@ -0,0 +1,109 @@
+import asyncio
+import atexit
+import os
+import threading
+
+import aiofiles
+import aiohttp
+
+from .PartialDownload import PartialDownload
+
+EPRINT_URL = "https://arxiv.org/e-print/"
+
+
+class AsyncFetcher:
+    """
+    Download e-prints over one shared aiohttp session. The connection pool
+    keeps connections alive between papers and caps how many run against a
+    single host. The event loop lives in a background thread, so
+    `download_source` can be called from the collector's worker threads in
+    place of `ArxivCollector.download_source`. The shared fetcher is closed
+    by `close_shared()`, at the latest when the interpreter exits.
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, limit=32, limit_per_host=8, chunk_size=1 << 16, timeout=300):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.session = self._call(self._make_session())
+
+    @classmethod
+    def shared(cls):
+        """Return the process-wide fetcher, creating it on first use."""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+                atexit.register(cls.close_shared)
+            return cls._shared
+
+    @classmethod
+    def close_shared(cls):
+        """Close the process-wide fetcher, if there is one; a later `shared()` opens a new one."""
+        with cls._shared_lock:
+            fetcher, cls._shared = cls._shared, None
+        if fetcher is not None:
+            fetcher.close()
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _make_session(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.limit, limit_per_host=self.limit_per_host, keepalive_timeout=60
+        )
+        # Bytes are stored as sent, as PartialDownload counts them.
+        return aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout), auto_decompress=False
+        )
+
+    async def fetch(self, url, file_path):
+        """
+        Stream url into `<file_path>.part`, resuming an interrupted download
+        with a Range request, and rename it into place once complete. Returns
+        False if the server refuses or the body comes up short.
+        """
+        download = PartialDownload(file_path)
+        if download.complete():
+            return download.finish()
+
+        while True:
+            headers = download.request_headers()
+            async with self.session.get(url, headers=headers) as response:
+                mode = download.begin(response.status, response.headers)
+                if mode is None:
+                    if headers:  # the server would not resume; start over once
+                        download.reset()
+                        continue
+                    return False
+                async with aiofiles.open(download.part_file, mode) as file:
+                    async for chunk in response.content.iter_chunked(self.chunk_size):
+                        await file.write(chunk)
+            break
+
+        return download.finish()
+
+    def download_source(self, path, id):
+        url = EPRINT_URL + id
+        tar_file = os.path.join(path, f"{id}.tar.gz")
+
+        # If tar_file exists, skip the download
+        if os.path.exists(tar_file):
+            print(f"{tar_file} already exists.")
+            return True
+
+        if self._call(self.fetch(url, tar_file)):
+            return True
+        print(f"Failed to download {id}: {os.path.basename(tar_file)}")
+        return False
+
+    def close(self):
+        self._call(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
@@ -0,0 +1,113 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class CrawlState:
+    """
+    Crawl progress per (paper id, keyword) in SQLite, in WAL mode so the
+    collector threads and the TikZ extraction can commit concurrently. Every
+    stage outcome is committed as soon as it is known, with a timestamp, so a
+    crashed run can pick up exactly where it stopped. TikZ extraction writes
+    one JSONL per subject, so its outcome is kept per subject as well.
+    """
+    STAGES = ("downloaded", "extracted", "matched")
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS papers (
+            paper_id TEXT NOT NULL,
+            keyword TEXT NOT NULL,
+            subject TEXT,
+            downloaded INTEGER, downloaded_at REAL,
+            extracted INTEGER, extracted_at REAL,
+            matched INTEGER, matched_at REAL,
+            PRIMARY KEY (paper_id, keyword)
+        );
+        CREATE TABLE IF NOT EXISTS tikz (
+            paper_id TEXT NOT NULL,
+            keyword TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            tikz_count INTEGER, tikz_error TEXT, tikz_at REAL,
+            PRIMARY KEY (paper_id, keyword, subject)
+        );
+    """
+    _opened = {}
+    _opened_lock = threading.Lock()
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.local = threading.local()
+        with self.connection as conn:
+            conn.executescript(self.SCHEMA)
+
+    @classmethod
+    def open(cls, db_file):
+        """Return the shared CrawlState for db_file, creating it on first use."""
+        db_file = os.path.abspath(db_file)
+        with cls._opened_lock:
+            if db_file not in cls._opened:
+                os.makedirs(os.path.dirname(db_file), exist_ok=True)
+                cls._opened[db_file] = cls(db_file)
+            return cls._opened[db_file]
+
+    @property
+    def connection(self):
+        """sqlite3 connections cannot be shared between threads, so each thread gets its own."""
+        conn = getattr(self.local, "connection", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=60)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = conn
+        return conn
+
+    def record(self, paper_id, keyword, subject, stage, ok):
+        """Commit the outcome of one of STAGES for a paper."""
+        if stage not in self.STAGES:
+            raise ValueError(f"Unknown stage {stage}")
+        with self.connection as conn:
+            conn.execute(
+                f"""INSERT INTO papers (paper_id, keyword, subject, {stage}, {stage}_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (paper_id, keyword) DO UPDATE SET
+                        subject = excluded.subject,
+                        {stage} = excluded.{stage},
+                        {stage}_at = excluded.{stage}_at""",
+                (paper_id, keyword, subject, int(bool(ok)), time.time()),
+            )
+
+    def record_tikz(self, paper_id, keyword, subject, count, error=None):
+        """Commit the outcome of TikZ extraction for a paper in one subject."""
+        with self.connection as conn:
+            conn.execute(
+                """INSERT INTO tikz (paper_id, keyword, subject, tikz_count, tikz_error, tikz_at)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (paper_id, keyword, subject) DO UPDATE SET
+                       tikz_count = excluded.tikz_count,
+                       tikz_error = excluded.tikz_error,
+                       tikz_at = excluded.tikz_at""",
+                (paper_id, keyword, subject, count, error, time.time()),
+            )
+
+    def _select(self, table, ids, condition, params):
+        rows = {}
+        ids = list(ids)
+        # stay below SQLite's limit on bound parameters
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            for row in self.connection.execute(
+                f"SELECT * FROM {table} WHERE {condition} AND paper_id IN ({placeholders})",
+                (*params, *batch),
+            ):
+                rows[row["paper_id"]] = dict(row)
+        return rows
+
+    def get(self, ids, keyword):
+        """Return {paper id: row} for the ids that have a record."""
+        return self._select("papers", ids, "keyword = ?", (keyword,))
+
+    def get_tikz(self, ids, keyword, subject):
+        """Return {paper id: row} for the ids whose TikZ outcome is recorded for subject."""
+        return self._select("tikz", ids, "keyword = ? AND subject = ?", (keyword, subject))
@@ -0,0 +1,80 @@
+import collections
+import os
+import threading
+
+import chardet
+
+
+class EncodingResolver:
+    """
+    Decide the encoding of a source file. Strict UTF-8 is tried first, since
+    it covers most papers and a successful decode is proof enough. Only when
+    it fails does chardet run, and only on a bounded sample around the first
+    byte that is not UTF-8. Results are cached per (path, mtime, size) for
+    the max_entries most recently used files. Extraction workers do not share
+    the cache, so they are handed the encodings the manifest recorded instead.
+    """
+
+    def __init__(self, sample_size=32 * 1024, fallback="latin-1", max_entries=4096):
+        self.sample_size = sample_size
+        self.fallback = fallback
+        self.max_entries = max_entries
+        # (path, mtime, size) -> encoding, least recently used first
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(path):
+        stat = os.stat(path)
+        return path, stat.st_mtime_ns, stat.st_size
+
+    def detect(self, data):
+        try:
+            data.decode("utf-8")
+            return "utf-8"
+        except UnicodeDecodeError as e:
+            start = max(0, e.start - self.sample_size // 4)
+            sample = data[start:start + self.sample_size]
+        encoding = chardet.detect(sample)["encoding"]
+        try:
+            # the sample may look like ascii or utf-8 while the rest is not
+            data.decode(encoding)
+            return encoding
+        except (TypeError, LookupError, UnicodeDecodeError):
+            return self.fallback
+
+    def resolve(self, path, data=None):
+        """Return the encoding of path; pass data if the bytes are already at hand."""
+        key = self._key(path)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        if data is None:
+            with open(path, "rb") as file:
+                data = file.read()
+        encoding = self.detect(data)
+        with self.lock:
+            self.cache[key] = encoding
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return encoding
+
+    def read(self, path, encoding=None):
+        """
+        Return (text, encoding) for path. A known encoding, such as the one
+        in the paper's manifest, is used without detection if it decodes.
+        """
+        with open(path, "rb") as file:
+            data = file.read()
+        if encoding is not None:
+            try:
+                return data.decode(encoding), encoding
+            except (LookupError, UnicodeDecodeError):
+                pass
+        encoding = self.resolve(path, data)
+        return data.decode(encoding), encoding
+
+
+# Shared by everything in one process, so the cache is too.
+default_resolver = EncodingResolver()
@@ -0,0 +1,96 @@
+import collections
+import os
+import shutil
+import threading
+
+
+class EprintCache:
+    """
+    One copy of every e-print, shared by all subjects. Entries are keyed by
+    arXiv id including its version, and the content of a version never
+    changes, so a cross-listed paper is downloaded once. Subject directories
+    get a hardlink to the cached tarball, or a copy where hardlinks are not
+    supported. The cache is kept under max_bytes by evicting the least
+    recently used entries. Evicting an entry does not remove the links that
+    subject directories already hold.
+    """
+    _opened = {}
+    _opened_lock = threading.Lock()
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.id_locks = collections.defaultdict(threading.Lock)
+        # id -> size, least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        tarballs = [
+            entry for entry in os.scandir(cache_dir)
+            if entry.is_file() and entry.name.endswith(".tar.gz")
+        ]
+        for entry in sorted(tarballs, key=lambda entry: entry.stat().st_mtime):
+            self.entries[entry.name[:-len(".tar.gz")]] = entry.stat().st_size
+            self.size += entry.stat().st_size
+
+    @classmethod
+    def open(cls, cache_dir, max_bytes):
+        """Return the shared cache for cache_dir, creating it on first use."""
+        cache_dir = os.path.abspath(cache_dir)
+        with cls._opened_lock:
+            if cache_dir not in cls._opened:
+                cls._opened[cache_dir] = cls(cache_dir, max_bytes)
+            return cls._opened[cache_dir]
+
+    def path(self, id):
+        return os.path.join(self.cache_dir, f"{id}.tar.gz")
+
+    def fetch(self, id, target, download):
+        """
+        Put e-print id at target. On a cache miss download(cache_dir, id) is
+        called to fill the cache first; its result is returned if it fails.
+        """
+        if os.path.exists(target):
+            return True
+        with self.id_locks[id]:
+            with self.lock:
+                if id in self.entries:
+                    self.entries.move_to_end(id)
+                    os.utime(self.path(id))
+                    self._link(self.path(id), target)
+                    return True
+            if not download(self.cache_dir, id):
+                return False
+            with self.lock:
+                self.entries[id] = os.path.getsize(self.path(id))
+                self.size += self.entries[id]
+                self._link(self.path(id), target)
+                self._evict()
+        return True
+
+    @staticmethod
+    def _link(source, target):
+        try:
+            os.link(source, target)
+        except FileExistsError:
+            pass
+        except OSError:
+            shutil.copyfile(source, target)
+
+    def discard(self, id):
+        """Drop e-print id, for instance because it cannot be read, so that the next fetch downloads it again."""
+        with self.lock:
+            size = self.entries.pop(id, None)
+            if size is None:
+                return
+            self.size -= size
+            if os.path.isfile(self.path(id)):
+                os.remove(self.path(id))
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            id, size = self.entries.popitem(last=False)
+            self.size -= size
+            if os.path.isfile(self.path(id)):
+                os.remove(self.path(id))
@@ -0,0 +1,99 @@
+from collections import namedtuple
+import re
+
+
+class FigureScanner:
+    """
+    Find figures, the tikzpictures inside them and their captions in one
+    left-to-right pass over a latex document. A single regex finds the
+    \\begin, \\end and \\caption commands that matter, and the scanner keeps
+    track of where it is with a small amount of state. Caption arguments are
+    read with balanced braces. Every tikzpicture of a figure is reported,
+    including those in subfigures, which carry their own caption as well.
+    """
+    Figure = namedtuple("Figure", ['start', 'end', 'caption', 'tikzpictures'])
+    Picture = namedtuple("Picture", ['start', 'end', 'subcaption'])
+
+    TOKEN_RE = re.compile(
+        r"\\(begin|end)\s*\{(figure\*?|subfigure\*?|tikzpicture)\}"
+        r"|\\(?:sub)?caption\s*(?:\[[^\]]*\])?\s*\{"
+    )
+    BRACE_RE = re.compile(r"\\.|[{}]", re.DOTALL)
+
+    def __init__(self, tex):
+        self.tex = tex
+
+    def _group(self, start):
+        """Return the end of the brace group whose { is just before start, or -1 if it is never closed."""
+        depth = 1
+        for match in self.BRACE_RE.finditer(self.tex, start):
+            token = match.group()
+            if token == "{":
+                depth += 1
+            elif token == "}":
+                depth -= 1
+                if not depth:
+                    return match.start()
+        return -1
+
+    def figures(self):
+        """Yield a Figure for every figure that contains at least one tikzpicture."""
+        figure = None  # [start, caption, pictures]
+        subfigure = None  # [caption, pictures]
+        tikz_start, tikz_depth = None, 0
+
+        pos = 0
+        while match := self.TOKEN_RE.search(self.tex, pos):
+            pos = match.end()
+            command, env = match.group(1, 2)
+
+            if env == "tikzpicture":
+                # only the outermost tikzpicture is a picture of its own
+                if command == "begin":
+                    if not tikz_depth:
+                        tikz_start = match.start()
+                    tikz_depth += 1
+                elif tikz_depth:
+                    tikz_depth -= 1
+                    if not tikz_depth and figure is not None:
+                        pictures = subfigure[1] if subfigure is not None else figure[2]
+                        pictures.append([tikz_start, match.end(), ""])
+            elif tikz_depth:
+                # whatever a tikzpicture contains is part of its code
+                continue
+            elif env is None:
+                end = self._group(pos) if figure is not None else -1
+                if end == -1:
+                    continue
+                caption = self.tex[pos:end]
+                if subfigure is not None:
+                    subfigure[0] = subfigure[0] or caption
+                else:
+                    figure[1] = figure[1] or caption
+                pos = end + 1
+            elif env.startswith("figure"):
+                if command == "begin" and figure is None:
+                    figure, subfigure = [match.start(), "", []], None
+                elif command == "end" and figure is not None:
+                    start, caption, pictures = figure
+                    if pictures:
+                        yield self.Figure(start, match.end(), caption, [self.Picture(*picture) for picture in pictures])
+                    figure = subfigure = None
+            elif figure is not None:
+                if command == "begin" and subfigure is None:
+                    subfigure = ["", []]
+                elif command == "end" and subfigure is not None:
+                    caption, pictures = subfigure
+                    for picture in pictures:
+                        picture[2] = caption
+                    figure[2].extend(pictures)
+                    subfigure = None
+
+    def pictures(self):
+        """Yield (tikz code, caption) for every tikzpicture in a figure."""
+        for figure in self.figures():
+            for picture in figure.tikzpictures:
+                caption = figure.caption
+                if picture.subcaption:
+                    caption = f"{caption} {picture.subcaption}" if caption else picture.subcaption
+                yield self.tex[picture.start:picture.end], caption
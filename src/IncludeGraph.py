@@ -0,0 +1,108 @@
+import os
+import re
+
+from .EncodingResolver import default_resolver
+
+
+class IncludeGraph:
+    """
+    The include graph of a paper, built once from its main file. Every file
+    reachable through \\input, \\include, \\subfile, \\import or \\subimport is
+    read, decoded and stripped of comments exactly once. Its include commands
+    become edges. An edge that would close a cycle, or go deeper than
+    max_depth, is cut and reported instead of followed. `splice()` then
+    assembles the merged document from memory, reusing the expansion of a
+    fragment that is included more than once. Encodings already known, from
+    the paper's manifest, are passed as a {path: encoding} dict.
+    """
+    INCLUDE_RE = re.compile(
+        r"\\(input|include|subfile)\s*\{([^}]+)\}|\\(import|subimport)\s*\{([^}]*)\}\s*\{([^}]+)\}"
+    )
+    # a % that is not escaped, and the rest of its line; the % itself is kept
+    COMMENT_RE = re.compile(r"(?<!\\)%.*")
+
+    def __init__(self, main_file, max_depth=16, resolver=default_resolver, encodings=None):
+        self.main_file = os.path.normpath(main_file)
+        self.max_depth = max_depth
+        self.resolver = resolver
+        self.known_encodings = {os.path.normpath(path): encoding for path, encoding in (encodings or {}).items()}
+        self.texts = {}
+        self.encodings = {}
+        # path -> [(start, end, kind, child path)] for each include command;
+        # child is None where the edge was cut
+        self.edges = {}
+        self.missing = []
+        self.cycles = []
+        self.too_deep = []
+        self._spliced = {}
+        self._visit(self.main_file, os.path.dirname(self.main_file), 0, [])
+
+    @staticmethod
+    def _locate(base, name):
+        """Resolve an include argument like LaTeX does: as given if it exists, else with .tex."""
+        path = os.path.normpath(os.path.join(base, name.strip()))
+        if os.path.splitext(path)[1] and os.path.isfile(path):
+            return path
+        return path if path.endswith(".tex") else path + ".tex"
+
+    def _visit(self, path, base, depth, stack):
+        text, self.encodings[path] = self.resolver.read(path, self.known_encodings.get(path))
+        text = self.texts[path] = self.COMMENT_RE.sub("%", text)
+        stack.append(path)
+
+        edges = self.edges[path] = []
+        for match in self.INCLUDE_RE.finditer(text):
+            kind, name, import_kind, directory, file = match.groups()
+            child_base = base
+            if import_kind == "import":
+                kind, child_base = import_kind, os.path.join(os.path.dirname(self.main_file), directory)
+                name = file
+            elif import_kind == "subimport":
+                kind, child_base = import_kind, os.path.join(base, directory)
+                name = file
+            if "#" in name:  # a macro parameter, as in \newcommand{\fig}[1]{\input{#1}}
+                continue
+            child = self._locate(child_base, name)
+
+            if child in stack:
+                self.cycles.append(stack[stack.index(child):] + [child])
+                child = None
+            elif depth + 1 > self.max_depth:
+                self.too_deep.append(child)
+                child = None
+            elif not os.path.isfile(child):
+                # leave the command in place, there is nothing to splice
+                self.missing.append(child)
+                continue
+            elif child not in self.texts:
+                self._visit(child, child_base, depth + 1, stack)
+            edges.append((match.start(), match.end(), kind, child))
+
+        stack.pop()
+
+    def files(self):
+        """The files that make up the document, in the order they were first reached."""
+        return list(self.texts)
+
+    def splice(self, path=None):
+        """Return the document rooted at path (the main file by default) with all includes spliced in."""
+        path = path or self.main_file
+        if path not in self._spliced:
+            text, out, pos = self.texts[path], [], 0
+            for start, end, kind, child in self.edges[path]:
+                out.append(text[pos:start])
+                out.append("\n")
+                if child is not None:
+                    out.append(self._body(self.splice(child)) if kind == "subfile" else self.splice(child))
+                pos = end
+            out.append(text[pos:])
+            self._spliced[path] = "".join(out)
+        return self._spliced[path]
+
+    @staticmethod
+    def _body(text):
+        """A \\subfile is a complete document; only its body belongs in the parent."""
+        begin, end = text.find(r"\begin{document}"), text.rfind(r"\end{document}")
+        if begin == -1 or end == -1:
+            return text
+        return text[begin + len(r"\begin{document}"):end]
@@ -1,11 +1,21 @@
 import os
 import json
-import subprocess
+import collections
+import concurrent.futures
+import multiprocessing
+from concurrent.futures.process import BrokenProcessPool
 import chardet
 
+from .MainFileResolver import MainFileResolver
+from .PaperManifest import PaperManifest
 from .TikzFinder import TikzFinder
 from .ColoredLogger import ColoredLogger
 
+# TikZ extraction pools are created while the collector and download
+# threads run; forking such a process is unsafe.
+MP_CONTEXT = multiprocessing.get_context("forkserver")
+
+
 class LatexProcessor:
     def __init__(self, app):
         self.logger = ColoredLogger().logger
@@ -26,54 +36,172 @@ class LatexProcessor:
         return []
 
 
+    def get_manifest(self, id):
+        manifest_file = PaperManifest.manifest_file(self.app.subject_path, id)
+        if os.path.isfile(manifest_file):
+            return PaperManifest.load(manifest_file)
+        # papers extracted before manifests existed
+        manifest = PaperManifest.build(os.path.join(self.app.subject_path, id), [self.app.keyword])
+        manifest.save(manifest_file)
+        return manifest
+
     def get_main_file_dict(self):
         file_paths_dict = {}
+        self.manifests = {}
+        resolver = MainFileResolver(
+            os.path.join(self.app.subject_path, f"{self.app.subject}_main_files.json")
+        )
         for id in self.capable_ids:
-            file_path = os.path.join(self.app.subject_path, id)
-            command = "grep -rl --include='*.tex' --exclude='*_merged.tex' 'documentclass' " + file_path
-            try:
-                result = subprocess.check_output(command, shell=True)
-                file_paths = result.decode('utf-8').strip().split('\n')
-                main_file_path = file_paths[0] if file_paths else None
-                file_paths_dict[id] = main_file_path
-            except subprocess.CalledProcessError:
-                file_paths_dict[id] = None
+            manifest = self.manifests[id] = self.get_manifest(id)
+            main_file = resolver.resolve(id, manifest)
+            file_paths_dict[id] = manifest.path(main_file) if main_file else None
+        resolver.save()
         self.logger.info(f"file_paths_dict:{file_paths_dict}")
         return file_paths_dict
 
 
 
 
-    def extract_and_save_tikz(self, output_directory):
-        system_content = "AutomaTikZ: Text-Guided Synthesis of Scientific Vector Graphics with TikZ"
-        with open(self.jsonl_file, 'w', encoding='utf-8') as f:
-            for id, path in self.ids_path.items():
-                try:
-                    tikz_finder = TikzFinder(path)
-                    tikz_figures = list(tikz_finder.find())
-
-                    for fig in tikz_figures:
-
-                        item = {
-                            "messages": [
-                                {"role": "system", "content": system_content},
-                                {"role": "user", "content": f"iArxiv-{id}:" + fig.caption},
-                                {"role": "assistant", "content": fig.code}
-                            ]
-                        }
-                        f.write(json.dumps(item) + '\n')
-                    print(f"Separated and saved {len(tikz_figures)} TikZ code:\n--> {path} from {id} to {self.jsonl_file}")
-                except Exception as e:
-                    self.logger.error(f"Error processing file {path}: {e}")
-
-
-
-
-
-
-
-
-
-
+    def encodings(self, id):
+        """{path: encoding} of the files of paper id, as its manifest recorded them."""
+        manifest = self.manifests[id]
+        return {manifest.path(name): info["encoding"] for name, info in manifest.files.items()}
 
+    def keep_lines(self, ids):
+        """
+        Drop the JSONL lines of papers not in ids. A run that stopped between
+        writing a paper's lines and committing it leaves lines that would be
+        written again.
+        """
+        prefix = "iArxiv-"
+        tmp_file = self.jsonl_file + ".tmp"
+        with open(self.jsonl_file, 'r', encoding='utf-8') as fin, open(tmp_file, 'w', encoding='utf-8') as fout:
+            for line in fin:
+                try:
+                    content = json.loads(line)["messages"][1]["content"]
+                except (ValueError, KeyError, IndexError, TypeError):
+                    continue
+                if content.startswith(prefix) and content[len(prefix):].partition(":")[0] in ids:
+                    fout.write(line)
+        os.replace(tmp_file, self.jsonl_file)
 
+    def extract_and_save_tikz(self, output_directory):
+        system_content = "AutomaTikZ: Text-Guided Synthesis of Scientific Vector Graphics with TikZ"
+        state, keyword, subject = self.app.state, self.app.keyword, self.app.subject
+
+        # Papers committed by an earlier run already have their lines in the
+        # JSONL, so skip them and append. Papers that failed run again.
+        done = set()
+        if os.path.isfile(self.jsonl_file):
+            rows = state.get_tikz(self.ids_path, keyword, subject)
+            done = {id for id, row in rows.items() if row["tikz_at"] is not None and row["tikz_error"] is None}
+            self.keep_lines(done)
+        papers = [(id, path, self.encodings(id)) for id, path in self.ids_path.items() if id not in done]
+        if done:
+            self.logger.info(f"Resuming {subject}: {len(done)} papers already extracted")
+
+        with open(self.jsonl_file, 'a' if done else 'w', encoding='utf-8') as f:
+            for id, path, tikz_figures, error in self.run_extraction(papers):
+                if error is not None:
+                    self.logger.error(f"Error processing file {path}: {error}")
+                    state.record_tikz(id, keyword, subject, 0, error)
+                    continue
+
+                for caption, code in tikz_figures:
+
+                    item = {
+                        "messages": [
+                            {"role": "system", "content": system_content},
+                            {"role": "user", "content": f"iArxiv-{id}:" + caption},
+                            {"role": "assistant", "content": code}
+                        ]
+                    }
+                    f.write(json.dumps(item) + '\n')
+                f.flush()
+                state.record_tikz(id, keyword, subject, len(tikz_figures))
+                print(f"Separated and saved {len(tikz_figures)} TikZ code:\n--> {path} from {id} to {self.jsonl_file}")
+
+    def run_extraction(self, papers):
+        """
+        Yield extract_tikz results for (id, path, encodings) papers. With more than one
+        worker the papers run in a process pool, in chunks of tikz_chunksize,
+        and come back in paper order (tikz_ordered) or as they complete.
+        """
+        workers, chunksize = self.app.tikz_workers, max(1, self.app.tikz_chunksize)
+        if workers <= 1:
+            for paper in papers:
+                yield extract_tikz(*paper)
+            return
+
+        chunks = [papers[i:i + chunksize] for i in range(0, len(papers), chunksize)]
+        pending, next_index = {}, 0
+        for index, results in self._run_chunks(chunks, workers):
+            if not self.app.tikz_ordered:
+                yield from results
+                continue
+            pending[index] = results
+            while next_index in pending:
+                yield from pending.pop(next_index)
+                next_index += 1
+
+    def _run_chunks(self, chunks, workers):
+        """
+        Yield (chunk index, results) as chunks complete. At most `workers`
+        chunks are in flight, so when a worker dies only those can be to
+        blame: their papers are rerun one by one in a process of their own,
+        and the remaining chunks go on in a fresh pool. A crash costs only
+        the paper that caused it.
+
+        The pool is started from a process with many threads running, so
+        workers come from a forkserver rather than a fork of it.
+        """
+        todo = collections.deque(range(len(chunks)))
+        while todo:
+            suspects = []
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=MP_CONTEXT) as executor:
+                running = {}
+                while todo or running:
+                    while todo and len(running) < workers:
+                        index = todo.popleft()
+                        running[executor.submit(extract_tikz_chunk, chunks[index])] = index
+                    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        index = running.pop(future)
+                        try:
+                            results = future.result()
+                        except BrokenProcessPool:
+                            suspects.append(index)
+                            continue
+                        yield index, results
+                    if suspects:
+                        # the pool is gone with everything still in it
+                        suspects.extend(running.values())
+                        break
+
+            for index in sorted(suspects):
+                yield index, [self._run_isolated(*paper) for paper in chunks[index]]
+
+    @staticmethod
+    def _run_isolated(id, path, encodings=None):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=MP_CONTEXT) as executor:
+            try:
+                return executor.submit(extract_tikz, id, path, encodings).result()
+            except BrokenProcessPool as e:
+                return id, path, [], f"worker crashed: {e}"
+
+
+def extract_tikz(id, path, encodings=None):
+    """
+    Extract the TikZ figures of one paper. Runs in worker processes, so it
+    returns plain data: (id, path, [(caption, code), ...], error message or None).
+    encodings are those of the paper's manifest, so workers need not detect them.
+    """
+    try:
+        tikz_figures = [(fig.caption, fig.code) for fig in TikzFinder(path, encodings=encodings).find()]
+        return id, path, tikz_figures, None
+    except Exception as e:
+        return id, path, [], str(e)
+
+
+def extract_tikz_chunk(papers):
+    return [extract_tikz(*paper) for paper in papers]
@@ -0,0 +1,68 @@
+import json
+import os
+
+
+class MainFileResolver:
+    """
+    Pick the main .tex file of a paper from its PaperManifest. Candidates are
+    ranked by, in order: having \\begin{document}, having \\documentclass, not
+    being included by another file, how many of the paper's other files they
+    include, and size. Decisions are cached per paper id, and optionally
+    persisted to a JSON file so reruns skip the ranking.
+    """
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self.cache = {}
+        if cache_file and os.path.isfile(cache_file):
+            with open(cache_file, "r") as file:
+                self.cache = json.load(file)
+
+    def save(self):
+        if self.cache_file:
+            with open(self.cache_file, "w") as file:
+                json.dump(self.cache, file)
+
+    @staticmethod
+    def _resolve_input(manifest, source, name):
+        """Map an \\input argument to a file of the paper, trying the paper root and then the includer's directory."""
+        if not os.path.splitext(name)[1]:
+            name += ".tex"
+        for base in ("", os.path.dirname(source)):
+            candidate = os.path.normpath(os.path.join(base, name))
+            if candidate in manifest.files:
+                return candidate
+        return None
+
+    @classmethod
+    def rank(cls, manifest):
+        """Return the paper's .tex files, best main-file candidate first."""
+        includes = {}
+        for name, info in manifest.files.items():
+            resolved = (cls._resolve_input(manifest, name, n) for n in info.get("inputs", []))
+            includes[name] = {r for r in resolved if r is not None and r != name}
+        included = set().union(*includes.values()) if includes else set()
+
+        def score(name):
+            info = manifest.files[name]
+            return (
+                info["begin_document"],
+                info["documentclass"],
+                name not in included,
+                len(includes[name]),
+                info["size"],
+            )
+
+        # sort by name first, so ties are broken the same way on every filesystem
+        return sorted(sorted(manifest.files), key=score, reverse=True)
+
+    def resolve(self, id, manifest):
+        """Return the main file of paper id relative to its directory, or None."""
+        if self.cache.get(id) in manifest.files:
+            return self.cache[id]
+        ranked = [
+            name for name in self.rank(manifest)
+            if manifest.files[name]["documentclass"] or manifest.files[name]["begin_document"]
+        ]
+        self.cache[id] = ranked[0] if ranked else None
+        return self.cache[id]
@@ -0,0 +1,79 @@
+import json
+import os
+import re
+
+from .EncodingResolver import default_resolver
+from .KeywordScanner import KeywordScanner
+
+
+class PaperManifest:
+    """
+    What later stages need to know about the .tex files of one extracted
+    paper, gathered in a single traversal right after extraction: size,
+    encoding, whether the file has \\documentclass or \\begin{document}, the
+    files it includes, and keyword hits. Paths are stored relative to the
+    paper directory.
+    """
+    DOCUMENTCLASS = r"\documentclass"
+    BEGIN_DOCUMENT = r"\begin{document}"
+    INCLUDE_RE = re.compile(
+        rb"\\(?:input|include|subfile)\s*\{([^}]+)\}|\\(?:sub)?import\s*\{([^}]*)\}\s*\{([^}]+)\}"
+    )
+
+    def __init__(self, root, keywords, files):
+        self.root = root
+        self.keywords = keywords
+        self.files = files
+
+    @staticmethod
+    def manifest_file(subject_path, id):
+        return os.path.join(subject_path, f"{id}.manifest.json")
+
+    @classmethod
+    def find_inputs(cls, data):
+        """Names of the files pulled in with \\input, \\include, \\subfile or \\import."""
+        inputs = []
+        for match in cls.INCLUDE_RE.finditer(data):
+            name, directory, file = match.groups()
+            name = name if name is not None else os.path.join(directory, file)
+            inputs.append(name.decode("utf-8", errors="replace").strip())
+        return inputs
+
+    @classmethod
+    def build(cls, root, keywords):
+        scanner = KeywordScanner(
+            [*keywords, cls.DOCUMENTCLASS, cls.BEGIN_DOCUMENT], exclude=("*%*", "*_merged.tex")
+        )
+        files = {}
+        for path in scanner.walk(root):
+            with open(path, "rb") as file:
+                data = file.read()
+            hits = scanner.scan_bytes(data)
+            files[os.path.relpath(path, root)] = {
+                "size": len(data),
+                "encoding": default_resolver.resolve(path, data),
+                "documentclass": cls.DOCUMENTCLASS in hits,
+                "begin_document": cls.BEGIN_DOCUMENT in hits,
+                "hits": {k: n for k, n in hits.items() if k in keywords},
+                "inputs": cls.find_inputs(data),
+            }
+        return cls(root, list(keywords), files)
+
+    @classmethod
+    def load(cls, manifest_file):
+        with open(manifest_file, "r") as file:
+            data = json.load(file)
+        return cls(data["root"], data["keywords"], data["files"])
+
+    def save(self, manifest_file):
+        with open(manifest_file, "w") as file:
+            json.dump({"root": self.root, "keywords": self.keywords, "files": self.files}, file)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def files_with(self, keyword):
+        return [name for name, info in self.files.items() if keyword in info["hits"]]
+
+    def main_candidates(self):
+        return [name for name, info in self.files.items() if info["documentclass"]]
@@ -0,0 +1,106 @@
+import json
+import os
+
+
+class PartialDownload:
+    """
+    Bookkeeping for a download that may be interrupted. Bytes received so far
+    live in `<target>.part`, and the journal `<target>.part.json` records the
+    length and validator (ETag or Last-Modified) the server announced. Bytes
+    are counted as sent, before any Content-Encoding is undone. A later
+    attempt asks for the missing tail with a Range request; the target itself
+    only appears once the part file is complete.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.part_file = target + ".part"
+        self.journal_file = self.part_file + ".json"
+        self.journal = self._load_journal()
+
+    def _load_journal(self):
+        if not (os.path.isfile(self.journal_file) and os.path.isfile(self.part_file)):
+            return {}
+        try:
+            with open(self.journal_file, "r") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_journal(self):
+        tmp_file = self.journal_file + ".tmp"
+        with open(tmp_file, "w") as file:
+            json.dump(self.journal, file)
+        os.replace(tmp_file, self.journal_file)
+
+    @property
+    def offset(self):
+        if not self.journal or not os.path.isfile(self.part_file):
+            return 0
+        return os.path.getsize(self.part_file)
+
+    @property
+    def validator(self):
+        return self.journal.get("etag") or self.journal.get("last_modified")
+
+    def complete(self):
+        """True if an earlier attempt received every byte but stopped before the rename."""
+        length = self.journal.get("length")
+        return length is not None and self.offset == length
+
+    def request_headers(self):
+        """Headers for the next request: a Range for the missing tail, if resumable."""
+        offset = self.offset
+        if offset and self.validator:
+            return {"Range": f"bytes={offset}-", "If-Range": self.validator}
+        return {}
+
+    def begin(self, status, headers):
+        """
+        Inspect the reply to a request made with `request_headers()`. Returns
+        the mode to open the part file with ("ab" to append to a resumed
+        download, "wb" to start over), or None if the reply is not usable.
+        """
+        if status == 206:
+            content_range = headers.get("Content-Range", "")
+            start = content_range.removeprefix("bytes ").partition("-")[0]
+            if start.isdigit() and int(start) == self.offset:
+                return "ab"
+            return None
+        if status != 200:
+            return None
+
+        length = headers.get("Content-Length")
+        self.journal = {
+            "length": int(length) if length and length.isdigit() else None,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+        }
+        self._save_journal()
+        return "wb"
+
+    def finish(self):
+        """
+        Move the part file into place if it holds the announced length.
+        Returns False and keeps the part file if it is still short; a part
+        file that overshot is discarded.
+        """
+        length = self.journal.get("length")
+        size = os.path.getsize(self.part_file) if os.path.isfile(self.part_file) else -1
+        if size < 0 or (length is not None and size < length):
+            return False
+        if length is not None and size > length:
+            self.reset()
+            return False
+        os.replace(self.part_file, self.target)
+        if os.path.isfile(self.journal_file):
+            os.remove(self.journal_file)
+        self.journal = {}
+        return True
+
+    def reset(self):
+        """Forget everything received so far."""
+        for file in (self.part_file, self.journal_file):
+            if os.path.isfile(file):
+                os.remove(file)
+        self.journal = {}
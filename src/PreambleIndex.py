@@ -0,0 +1,85 @@
+import re
+
+from .demacro import MacroTable, TexDemacro, Error as DemacroError, tokenize
+
+
+class PreambleIndex:
+    """
+    The macro and color definitions of a document preamble, compiled once
+    and shared by all of its figures. Macro definitions are parsed a single
+    time into a MacroTable; \\colorlet and \\definecolor statements are
+    mapped from color name to definition. The colors a figure needs are
+    found by intersecting these names with the words of the figure. Its
+    macros are found from the escape sequences and \\begin{...} names in
+    its tokens, without expanding anything, and de-macro only expands text
+    that refers to a macro. Shorthands without arguments are expanded once
+    for the whole document.
+    """
+    COLORLET_RE = re.compile(r'\\colorlet\{(\w+?)\}\{(\w+?)\}')
+    DEFINECOLOR_RE = re.compile(r'^\s*\\definecolor(?:\[\w+?\])?\{(\w+?)\}\{\w+?\}\{.+?\}', re.MULTILINE)
+    WORD_RE = re.compile(r"[\w@]+")
+    # expansions that go too deep or grow too large raise a DemacroError
+    DEMACRO_ERRORS = (DemacroError, TypeError)
+
+    def __init__(self, macros):
+        self.colorlets = {m.group(1): m.group().lstrip() for m in self.COLORLET_RE.finditer(macros)}
+        self.colordefs = {m.group(1): m.group().lstrip() for m in self.DEFINECOLOR_RE.finditer(macros)}
+        try:
+            self.table = MacroTable.from_str(macros) if macros else MacroTable()
+        except self.DEMACRO_ERRORS:
+            self.table = MacroTable()
+        # expansions of macros without arguments, shared by all figures
+        self.expansions = {}
+
+    @classmethod
+    def words(cls, text):
+        """The words of text, which include the color names it uses."""
+        return set(cls.WORD_RE.findall(text))
+
+    def _demacro(self):
+        return TexDemacro(table=self.table, expansions=self.expansions)
+
+    def _tokens(self, text):
+        """text as tokens, or None if it refers to no macro of the table."""
+        if not len(self.table) or not text:
+            return None
+        try:
+            tokens = tokenize(text)
+        except self.DEMACRO_ERRORS:
+            return None
+        return tokens if self.table.references(tokens) else None
+
+    def macros(self, tikz):
+        """The definitions of the macros tikz uses, directly or through other macros."""
+        tokens = self._tokens(tikz)
+        if tokens is None:
+            return ""
+        try:
+            return "\n\n".join(self.table.find(tokens)).strip()
+        except self.DEMACRO_ERRORS:
+            return ""
+
+    def expand(self, text):
+        """text with all macros expanded."""
+        if self._tokens(text) is None:
+            return text
+        try:
+            return self._demacro().process(text)
+        except self.DEMACRO_ERRORS:
+            return text
+
+    @staticmethod
+    def _select(definitions, words):
+        """The definitions whose name is in words, in definition order."""
+        names = words & definitions.keys()
+        return [definition for name, definition in definitions.items() if name in names] if names else []
+
+    def colors(self, tikz, words=None):
+        """Return (\\definecolor statements, \\colorlet statements) tikz uses."""
+        words = self.words(tikz) if words is None else words
+        colorlets = self._select(self.colorlets, words)
+        # a colorlet may be based on a defined color
+        if colorlets:
+            words = words | self.words("\n".join(colorlets))
+        colordefs = self._select(self.colordefs, words)
+        return "\n".join(colordefs).strip(), "\n".join(colorlets).strip()
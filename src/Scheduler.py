@@ -0,0 +1,118 @@
+import concurrent.futures
+import itertools
+import queue
+import threading
+
+# Priority of the sentinel that stops a worker; sorts after every real item.
+_STOP_PRIORITY = (float("inf"),)
+
+
+class _Subject:
+    def __init__(self, ids, stages, on_done):
+        self.ids = ids
+        self.stages = stages
+        self.on_done = on_done
+        self.remaining = len(ids)
+        self.passed = []
+
+
+class Scheduler:
+    """
+    One work queue for the (subject, paper) items of a whole crawl, instead of
+    a thread pool per subject. Each pipeline stage is tagged with the resource
+    it uses ("network", "disk" or "cpu"). Every resource has a fixed number of
+    worker threads pulling from its own priority queue, so concurrency is
+    bounded globally. Papers are admitted round-robin across subjects (largest
+    subject first in each round), and papers further along the pipeline are
+    served first. A worker that runs out of work in one subject just takes the
+    next subject's, so big subjects no longer straggle at the end of a run.
+    """
+
+    def __init__(self, network=16, disk=4, cpu=4, max_inflight=64, finish_workers=1):
+        self.limits = {"network": network, "disk": disk, "cpu": cpu}
+        self.queues = {resource: queue.PriorityQueue() for resource in self.limits}
+        # Bounds the papers between download and their last stage, and so the
+        # tarballs and extracted trees on disk at any time.
+        self.max_inflight = max_inflight
+        self.admission = threading.BoundedSemaphore(max_inflight)
+        # on_done callbacks (fit-file writing and TikZ extraction) run here,
+        # not on the stage workers.
+        self.finisher = concurrent.futures.ThreadPoolExecutor(max_workers=finish_workers)
+        self.subjects = []
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+
+    def add(self, ids, stages, on_done):
+        """
+        Register a subject: ids go through stages, a list of (func, resource)
+        where func(id) returns whether the paper moves on. on_done receives
+        the ids that passed every stage, in their original order.
+        """
+        self.subjects.append(_Subject(list(ids), stages, on_done))
+
+    def _put(self, subject, index, id, stage):
+        func, resource = subject.stages[stage]
+        self.queues[resource].put(((-stage, index), next(self.seq), (subject, index, id, stage)))
+
+    def _finish(self, subject, index, id, passed):
+        with self.lock:
+            if passed:
+                subject.passed.append((index, id))
+            subject.remaining -= 1
+            done = subject.remaining == 0
+        self.admission.release()
+        if done:
+            self._done(subject)
+
+    def _done(self, subject):
+        fit_ids = [id for _, id in sorted(subject.passed)]
+        self.pending.append(self.finisher.submit(subject.on_done, fit_ids))
+
+    def _worker(self, inbox):
+        while True:
+            priority, _, item = inbox.get()
+            if priority == _STOP_PRIORITY:
+                return
+            subject, index, id, stage = item
+            func, _ = subject.stages[stage]
+            try:
+                ok = func(id)
+            except Exception as e:
+                print(f"Failed {func.__name__} {id}: {e}")
+                ok = False
+            if ok and stage + 1 < len(subject.stages):
+                self._put(subject, index, id, stage + 1)
+            else:
+                self._finish(subject, index, id, ok)
+
+    def run(self):
+        self.pending = []
+        workers = []
+        for resource, limit in self.limits.items():
+            for _ in range(max(1, limit)):
+                thread = threading.Thread(target=self._worker, args=(self.queues[resource],), daemon=True)
+                thread.start()
+                workers.append((resource, thread))
+
+        for subject in self.subjects:
+            if not subject.ids:
+                self._done(subject)
+
+        by_size = sorted(self.subjects, key=lambda subject: len(subject.ids), reverse=True)
+        for index in range(max((len(subject.ids) for subject in by_size), default=0)):
+            for subject in by_size:
+                if index < len(subject.ids):
+                    self.admission.acquire()
+                    self._put(subject, index, subject.ids[index], 0)
+
+        # every admitted paper gives its slot back when it is finished
+        for _ in range(self.max_inflight):
+            self.admission.acquire()
+
+        for resource, thread in workers:
+            self.queues[resource].put((_STOP_PRIORITY, next(self.seq), None))
+        for resource, thread in workers:
+            thread.join()
+        for future in self.pending:
+            future.result()
+        self.finisher.shutdown()
@@ -60,6 +60,7 @@ then remove all *-clean.tex files!
 
 """
 
+import array
 import getopt
 import logging
 import os
@@ -91,6 +92,12 @@ class Empty_text_error(Error):
         self.data = data
         self.message = message
 
+class Budget_error(Error):
+    """Exception raised when an expansion nests deeper than max_depth or
+    produces more than max_output tokens.
+    """
+    pass
+
 def warn(error_message, detail = no_detail):
     sys.stderr.write(error_message + "\n")
     if no_detail != detail:
@@ -217,28 +224,248 @@ esc_symb_ty = g_token.esc_symb_ty
 esc_str_ty = g_token.esc_str_ty
 
 
+# Compact token lists
+
+# Internal codes of a TokenArray. Codes below 4 are token types, the others
+# are simple tokens that the scanner needs to recognize quickly.
+begin_group_code = 4
+end_group_code = 5
+param_code = 6
+blank_code = 7
+code_types = (simple_ty, esc_symb_ty, esc_str_ty, comment_ty,
+              simple_ty, simple_ty, simple_ty, simple_ty)
+simple_codes = {"{": begin_group_code, "}": end_group_code, "#": param_code}
+
+def token_code(type_v, val_v):
+    if simple_ty != type_v:
+        return type_v
+    if val_v in simple_codes:
+        return simple_codes[val_v]
+    if blank_re.match(val_v):
+        return blank_code
+    return simple_ty
+
+
+class Sources:
+    """The strings that the tokens of TokenArrays point into: source texts,
+    and escape names, which are interned so that each is stored once.
+    """
+
+    def __init__(self, strings=()):
+        self.strings = []
+        self.index = {}
+        self.maps = {}
+        for string in strings:
+            self.add(string)
+
+    def add(self, string):
+        i = self.index.get(string)
+        if i is None:
+            i = self.index[string] = len(self.strings)
+            self.strings.append(string)
+        return i
+
+    def translate(self, other):
+        """Map the indices of other to ours.
+        Returns None if they are the same, which is the case for other
+        itself and for any Sources that ours started as a copy of.
+        """
+        if other is self:
+            return None
+        entry = self.maps.get(id(other))
+        if entry is None or entry[0] is not other:
+            entry = self.maps[id(other)] = [other, [], True]
+        mapping = entry[1]
+        if len(mapping) < len(other.strings):
+            for string in other.strings[len(mapping):]:
+                mapping.append(self.add(string))
+            entry[2] = all(i == j for i, j in enumerate(mapping))
+        return None if entry[2] else mapping
+
+    def __getstate__(self):
+        return {"strings": self.strings, "index": self.index, "maps": {}}
+
+
+class TokenArray:
+    """A token list stored as parallel arrays: a code (see code_types), an
+    index into sources, and the start and end of the token in that string.
+    Escape names are interned in sources and take the whole string. Token
+    objects are only made when an item is read; a slice is a view that
+    shares the arrays of the array it was taken from.
+    """
+
+    def __init__(self, sources=None, tokens=None):
+        self.sources = sources if sources is not None else Sources()
+        self.codes = array.array("b")
+        self.srcs = array.array("i")
+        self.starts = array.array("l")
+        self.ends = array.array("l")
+        self.lo, self.hi = 0, None
+        if tokens is not None:
+            self.extend(tokens)
+
+    def view(self, lo, hi):
+        out = TokenArray.__new__(TokenArray)
+        out.sources = self.sources
+        out.codes, out.srcs, out.starts, out.ends = self.codes, self.srcs, self.starts, self.ends
+        out.lo, out.hi = lo, hi
+        return out
+
+    def __len__(self):
+        return (len(self.codes) if self.hi is None else self.hi) - self.lo
+
+    def code(self, i):
+        return self.codes[self.lo + i]
+
+    def val(self, i):
+        i += self.lo
+        string = self.sources.strings[self.srcs[i]]
+        if self.codes[i] in (esc_symb_ty, esc_str_ty):
+            return string
+        return string[self.starts[i]:self.ends[i]]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                raise ValueError("TokenArray slices must be contiguous.")
+            return self.view(self.lo + start, self.lo + max(start, stop))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("TokenArray index out of range")
+        return Token(code_types[self.codes[self.lo + i]], self.val(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __add__(self, other):
+        out = TokenArray(self.sources)
+        out.extend(self)
+        out.extend(other)
+        return out
+
+    def show(self):
+        return detokenize(self)
+
+    def add(self, code, src, start, end):
+        if self.lo or self.hi is not None:
+            raise Error("A TokenArray slice cannot be appended to.")
+        self.codes.append(code)
+        self.srcs.append(src)
+        self.starts.append(start)
+        self.ends.append(end)
+
+    def add_escape(self, type_v, name):
+        self.add(type_v, self.sources.add(name), 0, len(name))
+
+    def append(self, token):
+        if token.type in (esc_symb_ty, esc_str_ty):
+            self.add_escape(token.type, token.val)
+        else:
+            self.add(token_code(token.type, token.val), self.sources.add(token.val), 0, len(token.val))
+
+    def extend(self, tokens):
+        if not isinstance(tokens, TokenArray):
+            for token in tokens:
+                self.append(token)
+            return
+        if self.lo or self.hi is not None:
+            raise Error("A TokenArray slice cannot be appended to.")
+        lo, hi = tokens.lo, tokens.lo + len(tokens)
+        mapping = self.sources.translate(tokens.sources)
+        self.codes.extend(tokens.codes[lo:hi])
+        if mapping is None:
+            self.srcs.extend(tokens.srcs[lo:hi])
+        else:
+            self.srcs.extend(array.array("i", [mapping[s] for s in tokens.srcs[lo:hi]]))
+        self.starts.extend(tokens.starts[lo:hi])
+        self.ends.extend(tokens.ends[lo:hi])
+
+    def split_first(self, i):
+        """Take the first character off the simple token i.
+        Returns it as a TokenArray of one token; the token keeps the rest.
+        """
+        j = self.lo + i
+        first = TokenArray(self.sources)
+        val = self.val(i)
+        first.add(token_code(simple_ty, val[0]), self.srcs[j], self.starts[j], self.starts[j] + 1)
+        self.starts[j] += 1
+        self.codes[j] = token_code(simple_ty, val[1:])
+        return first
+
+    def add_match(self, src, match, isatletter=False):
+        """Append the token of a token_re match on sources.strings[src].
+        Returns its code.
+        """
+        val = match.group()
+        first = val[0]
+        if "\\" == first:
+            name = val[1:] or "\\"
+            code = esc_str_ty if isletter(name[0], isatletter) else esc_symb_ty
+            self.add(code, self.sources.add(name), 0, len(name))
+            return code
+        if "%" == first:
+            code = comment_ty
+        elif first.isspace():
+            code = blank_code
+        else:
+            code = simple_codes.get(val, simple_ty)
+        self.add(code, src, match.start(), match.end())
+        return code
+
+    def detokenize(self, isatletter=False, start=0, end=None):
+        """detokenize for tokens start to end, straight from the arrays."""
+        strings, codes, srcs, starts, ends = self.sources.strings, self.codes, self.srcs, self.starts, self.ends
+        end = len(self) if end is None else end
+        out = []
+        after_esc_str = False
+        for i in range(self.lo + start, self.lo + end):
+            code = codes[i]
+            string = strings[srcs[i]]
+            if code in (esc_symb_ty, esc_str_ty):
+                out.append("\\")
+                out.append(string)
+                after_esc_str = esc_str_ty == code
+                continue
+            val = string[starts[i]:ends[i]]
+            # a separating space after an escape string followed by a letter
+            if after_esc_str and comment_ty != code and isletter(val[0], isatletter):
+                out.append(" ")
+            out.append(val)
+            after_esc_str = False
+        return "".join(out)
+
+    def find_code(self, codes, start=0):
+        """The index of the first token from start on whose code is in codes, or len(self)."""
+        all_codes, lo = self.codes, self.lo
+        for i in range(self.lo + start, self.lo + len(self)):
+            if all_codes[i] in codes:
+                return i - lo
+        return len(self)
+
+
 def detokenize(text, isatletter=False):
     """
     Input is a list of tokens.
     Output is a string.
     """
-    out = ""
     if 0 == len(text):
-        return
-    pos = 0
-    out += text[pos].show()
-    pos += 1
-    while pos < len(text):
-        previtem = text[pos-1]
-        item = text[pos]
+        return ""
+    if isinstance(text, TokenArray):
+        return text.detokenize(isatletter)
+    out = []
+    previtem = None
+    for item in text:
         """Insert a separating space after an escape sequence if it is a
         string and is followed by a letter."""
-        if (esc_str_ty == previtem.type
+        if (None != previtem and esc_str_ty == previtem.type
             and simple_ty == item.type and isletter(item.val[0], isatletter)):
-            out += " "
-        out += item.show()
-        pos += 1
-    return out
+            out.append(" ")
+        out.append(item.show())
+        previtem = item
+    return "".join(out)
 
 
 def strip_comments(text):
@@ -246,6 +473,14 @@ def strip_comments(text):
     Input is a list of tokens.
     Output is the same list except the comment tokens.
     """
+    if isinstance(text, TokenArray):
+        out = TokenArray(text.sources)
+        pos = 0
+        while pos < len(text):
+            comment = text.find_code((comment_ty,), pos)
+            out.extend(text[pos:comment])
+            pos = comment + 1
+        return out
     out = []
     for token in text:
         if not comment_ty == token.type:
@@ -277,8 +512,10 @@ token_ty = g_group.token_ty
 group_ty = g_group.group_ty
 
 
-def tokenize(in_str, isatletter=False):
-    """Returns a list of tokens.
+def tokenize_chars(in_str, isatletter=False):
+    """Returns a list of tokens, one for every plain character.
+    This is the original character by character tokenizer, kept as the
+    reference for tokenize.
     """
     text = []
     cs = Char_stream(in_str)
@@ -307,6 +544,67 @@ def tokenize(in_str, isatletter=False):
     return text
 
 
+def token_re(isatletter):
+    r"""The master regex for tokenize: a comment with the blank space after
+    it, an escape sequence, a run of blank space, a digit after #, or a run
+    of plain text. Anything else (one of \ % { } [ ] #) is a token of its own.
+    """
+    letter = r"(?:[^\W\d_]|@)" if isatletter else r"[^\W\d_]"
+    return re.compile(
+        r"%%[^\n]*\s*|\\(?:%s+|.)?|\s+|(?<=#)\d|[^\\%%{}\[\]#\s]+|." % letter,
+        re.DOTALL)
+
+token_res = (token_re(False), token_re(True))
+blank_run_re = re.compile(r"\s*")
+input_filename_re = re.compile(r"\s*(?:{([^}]*)}?|(\S*))")
+package_filenames_re = re.compile(r"\s*(?:{([^\s}]*))?")
+
+def tokenize(in_str, isatletter=False, sources=None):
+    """Returns a TokenArray.
+    Runs of plain text and of blank space are single tokens, otherwise
+    the tokens are the same as those of tokenize_chars.
+    """
+    if not in_str:
+        raise Error("No string to tokenize.")
+    text = TokenArray(sources)
+    src = text.sources.add(in_str)
+    pos = 0
+    while pos < len(in_str):
+        # the regex only changes at \\makeatletter and \\makeatother
+        for match in token_res[isatletter].finditer(in_str, pos):
+            if esc_str_ty == text.add_match(src, match, isatletter):
+                name = match.group()[1:]
+                if name in ("makeatletter", "makeatother"):
+                    isatletter = "makeatletter" == name
+                    pos = match.end()
+                    break
+        else:
+            break
+    return text
+
+
+def scan_input_filename(in_str, pos):
+    """We have just read an \\input token.  The next group or word will be
+    interpreted as a filename (possibly without .tex).
+    Returns (filename, end).
+    """
+    match = input_filename_re.match(in_str, pos)
+    braced, word = match.groups()
+    return (braced if braced is not None else word), match.end()
+
+
+def scan_package_filenames(in_str, pos):
+    r"""We just read a \usepackage token.  The next group will be
+    interpreted as a list of filenames (without .sty) separated by commas.
+    Returns (list, end).
+    """
+    match = package_filenames_re.match(in_str, pos)
+    if match.group(1) is None:
+        raise Error("\\usepackage not followed by brace.")
+    # like Char_stream, skip the character that ended the first name
+    return match.group(1).split(","), match.end() + 1
+
+
 class Command_def:
     name = "1"
     numargs = 0
@@ -318,11 +616,11 @@ class Command_def:
         self.body = body_v
 
     def show(self):
-        out = "\\newcommand{\\%s}" % (self.name)
+        out = ["\\newcommand{\\%s}" % (self.name)]
         if 0 < self.numargs:
-            out += "[%d]" % self.numargs
-        out += "{%s}" % detokenize(self.body)
-        return out
+            out.append("[%d]" % self.numargs)
+        out.append("{%s}" % detokenize(self.body))
+        return "".join(out)
 
 
 class Env_def:
@@ -338,12 +636,12 @@ class Env_def:
         self.end = end_v
 
     def show(self):
-        out = "\\newenvironment{%s}" % self.name
+        out = ["\\newenvironment{%s}" % self.name]
         if 0 < self.numargs:
-            out += "[%d]" % self.numargs
-        out += "{%s}" % detokenize(self.begin)
-        out += "{%s}" % detokenize(self.end)
-        return out
+            out.append("[%d]" % self.numargs)
+        out.append("{%s}" % detokenize(self.begin))
+        out.append("{%s}" % detokenize(self.end))
+        return "".join(out)
 
 
 class Command_instance:
@@ -355,10 +653,9 @@ class Command_instance:
         self.args = args_v
 
     def show(self):
-        out = "\\"+self.name
-        for arg in self.args:
-            out += "{%s}" % detokenize(arg)
-        return out
+        out = ["\\"+self.name]
+        out.extend("{%s}" % detokenize(arg) for arg in self.args)
+        return "".join(out)
 
 
 class Env_instance:
@@ -371,12 +668,11 @@ class Env_instance:
         self.body = body_v
 
     def show(self):
-        out = "\\begin{%s}" % self.name
-        for arg in self.args:
-            out += "{%s}" % detokenize(arg)
-        out += detokenize(self.body)
-        out += "\\end{%s}" % self.name
-        return out
+        out = ["\\begin{%s}" % self.name]
+        out.extend("{%s}" % detokenize(arg) for arg in self.args)
+        out.append(detokenize(self.body))
+        out.append("\\end{%s}" % self.name)
+        return "".join(out)
 
 class Char_stream(Stream):
 
@@ -448,12 +744,117 @@ class Char_stream(Stream):
         return file.split(",")
 
 
+class MacroTable:
+    """Command and environment definitions, parsed once.
+    A table can be pickled and shared read-only by any number of TexDemacro
+    instances, also in other processes; they only tokenize their own text.
+    It also keeps the order of the definitions and which macros each of
+    them refers to, so the definitions a text needs can be found without
+    expanding it.
+    """
+
+    def __init__(self, command_defs=None, env_defs=None):
+        self.defs = (command_defs if command_defs is not None else {},
+                     env_defs if env_defs is not None else {})
+        self.sources = Sources()
+        # (kind, name) of each definition, kind being "command" or "env"
+        self.order = [("command", name) for name in self.defs[0]] + \
+                     [("env", name) for name in self.defs[1]]
+        self.graph = None
+
+    @classmethod
+    def from_str(cls, defs_str):
+        table = cls()
+        table.add_defs_str(defs_str)
+        return table
+
+    def add_defs_str(self, defs_str):
+        ds = TexDemacro()
+        ds.defs = self.defs
+        ds.sources = self.sources
+        ds.def_order = self.order
+        ds.smart_tokenize(defs_str, isatletter=True)
+        # changing ds.defs will change self.defs
+        ds.scan_defs()
+        self.graph = None
+
+    def __len__(self):
+        command_defs, env_defs = self.defs
+        return len(command_defs) + len(env_defs)
+
+    def references(self, text):
+        """The defined macros text refers to, as (kind, name), in order.
+        Commands are found by their escape tokens and environments by
+        \\begin{name}.
+        """
+        command_defs, env_defs = self.defs
+        refs = []
+        pos = text.find_code((esc_symb_ty, esc_str_ty))
+        while pos < len(text):
+            name = text.val(pos)
+            pos += 1
+            if "begin" == name and pos < len(text) and begin_group_code == text.code(pos):
+                end = text.find_code((end_group_code,), pos)
+                env_name = text.detokenize(start=pos + 1, end=end)
+                if env_name in env_defs:
+                    refs.append(("env", env_name))
+                pos = end
+            elif name in command_defs:
+                refs.append(("command", name))
+            pos = text.find_code((esc_symb_ty, esc_str_ty), pos)
+        return refs
+
+    def dependencies(self):
+        """The dependency graph: (kind, name) -> the macros its definition refers to."""
+        if self.graph is None:
+            command_defs, env_defs = self.defs
+            self.graph = {}
+            for name, command_def in command_defs.items():
+                self.graph[("command", name)] = tuple(dict.fromkeys(self.references(command_def.body)))
+            for name, env_def in env_defs.items():
+                self.graph[("env", name)] = tuple(dict.fromkeys(
+                    self.references(env_def.begin) + self.references(env_def.end)))
+        return self.graph
+
+    def closure(self, refs):
+        """refs and everything they depend on, directly or not."""
+        graph = self.dependencies()
+        seen = set()
+        stack = list(refs)
+        while stack:
+            ref = stack.pop()
+            if ref not in seen:
+                seen.add(ref)
+                stack.extend(graph.get(ref, ()))
+        return seen
+
+    def find(self, text):
+        """The definitions text needs, in the order they were defined."""
+        command_defs, env_defs = self.defs
+        needed = self.closure(self.references(text))
+        return [(command_defs if "command" == kind else env_defs)[name].show()
+                for kind, name in dict.fromkeys(self.order) if (kind, name) in needed]
+
+
 class TexDemacro(Stream):
     defs_db = "x"
     defs_db_file = "x.db"
-
-    def __init__(self, macros=None, *args, **kwargs):
-        self.defs = ({}, {})
+    # budgets of expand
+    max_depth = 100
+    max_output = 1 << 20
+
+    def __init__(self, macros=None, table=None, *args, expansions=None, **kwargs):
+        # the definitions of a table are shared until they are added to
+        self.defs = table.defs if table is not None else ({}, {})
+        self.shared_defs = table is not None
+        self.table = table
+        # (kind, name) of the definitions in the order they were scanned
+        self.def_order = list(table.order) if table is not None else []
+        # starting from the table's sources, its bodies can be copied as is
+        self.sources = Sources(table.sources.strings if table is not None else ())
+        # name -> expansion of a macro without arguments; may be shared
+        # between instances that have the same definitions
+        self.expansions = {} if expansions is None else expansions
         super().__init__(*args, **kwargs)
         if macros:
             self.add_defs_str(macros)
@@ -462,60 +863,51 @@ class TexDemacro(Stream):
         """Returns a list of tokens.
         It may interpret and carry out all \\input commands.
         """
-        self.data = []
+        self.data = TokenArray(self.sources)
         text = self.data
-        cs = Char_stream(in_str)
-        cs.reset()
-        if not cs.legal():
+        if not in_str:
             raise Error("No string to tokenize.")
-        while cs.uplegal():
-            if "%" == cs.item:
-                comment = cs.scan_comment_token()
-                text.append(Token(comment_ty, comment))
-            elif "\\" != cs.item:
-                text.append(Token(simple_ty, cs.item))
-                cs.next()
-            else:
-                cs.next()
-                name = cs.scan_escape_token(isatletter)
-                if "input" == name and handle_inputs:
-                    file = cs.scan_input_filename()
-                    to_add = self.process_if_newer(file)
-                    text.extend(to_add)
-                elif "usepackage" == name:
-                    while cs.uplegal() and blank_re.match(cs.item):
-                        cs.next()
-                    if "[" == cs.item: # Packages with options will not be processed.
-                        text.extend([Token(esc_str_ty, "usepackage"),
-                                     Token(simple_ty, "[")])
-                        cs.next()
+        src = text.sources.add(in_str)
+        pos = 0
+        while pos < len(in_str):
+            match = token_res[isatletter].match(in_str, pos)
+            pos = match.end()
+            name = match.group()[1:]
+            if "\\" != match.group()[0]:
+                text.add_match(src, match, isatletter)
+            elif "input" == name and handle_inputs:
+                file, pos = scan_input_filename(in_str, pos)
+                to_add = self.process_if_newer(file)
+                text.extend(to_add)
+            elif "usepackage" == name:
+                pos = blank_run_re.match(in_str, pos).end()
+                if "[" == in_str[pos:pos+1]: # Packages with options will not be processed.
+                    text.extend([Token(esc_str_ty, "usepackage"),
+                                 Token(simple_ty, "[")])
+                    pos += 1
+                    continue
+                files, pos = scan_package_filenames(in_str, pos)
+                i = 0
+                while i < len(files):  # process private packages
+                    file = files[i]
+                    p = file.rfind("-private")
+                    if p < 0 or not len(file) - len("-private") == p:
+                        i += 1
                         continue
-                    files = cs.scan_package_filenames()
-                    i = 0
-                    while i < len(files):  # process private packages
-                        file = files[i]
-                        p = file.rfind("-private")
-                        if p < 0 or not len(file) - len("-private") == p:
-                            i += 1
-                            continue
-                        defs_db_file = file+".db"
-                        self.add_defs(file)
-                        del files[i:(i+1)]
-                    if files: # non-private packages left
-                        group_content = ",".join(files)
-                        to_add_str = "\\usepackage{%s}" % (group_content)
-                        to_add = tokenize(to_add_str,isatletter)
-                        text.extend(to_add)
-                else:
-                    if isletter(name[0], isatletter):
-                        token = Token(esc_str_ty, name)
-                    else:
-                        token = Token(esc_symb_ty, name)
-                    text.append(token)
-                    if "makeatletter" == name:
-                        isatletter=True
-                    elif "makeatother" == name:
-                        isatletter=False
+                    defs_db_file = file+".db"
+                    self.add_defs(file)
+                    del files[i:(i+1)]
+                if files: # non-private packages left
+                    group_content = ",".join(files)
+                    to_add_str = "\\usepackage{%s}" % (group_content)
+                    to_add = tokenize(to_add_str,isatletter,self.sources)
+                    text.extend(to_add)
+            else:
+                text.add_match(src, match, isatletter)
+                if "makeatletter" == name:
+                    isatletter=True
+                elif "makeatother" == name:
+                    isatletter=False
         self.reset()
         return self.data
 
@@ -528,30 +920,28 @@ class TexDemacro(Stream):
         self.reset()
         if not self.legal():
             return ""
-        out = ""
-        previtem = None
+        if not handle_inputs:
+            return self.data.detokenize(isatletter)
+        out = []
+        start = 0
         while self.uplegal():
             item = self.item
-            """Insert a separating space after an escape sequence if it is a
-            string and is followed by a letter."""
-            if (None != previtem and esc_str_ty == previtem.type
-                and simple_ty == item.type and isletter(item.val[0], isatletter)):
-                out += " "
-            previtem = item
-            if not (esc_str_ty == item.type and "input" == item.val and handle_inputs):
-                out += item.show()
-                self.next()
-            else:
+            if not (esc_str_ty == item.type and "input" == item.val):
                 self.next()
-                group = self.scan_group()
-                file = detokenize(group.val)
-                clean_file = "%s-clean.tex" % (file)
-                logging.info("Reading file %s" % (clean_file))
-                fp = open(clean_file,"r")
-                content = fp.read()
-                fp.close()
-                out += content
-        return out
+                continue
+            out.append(self.data.detokenize(isatletter, start, self.pos))
+            self.next()
+            group = self.scan_group()
+            file = detokenize(group.val)
+            clean_file = "%s-clean.tex" % (file)
+            logging.info("Reading file %s" % (clean_file))
+            fp = open(clean_file,"r")
+            content = fp.read()
+            fp.close()
+            out.append(content)
+            start = self.pos
+        out.append(self.data.detokenize(isatletter, start, len(self.data)))
+        return "".join(out)
 
     # Basic tex scanning
 
@@ -565,26 +955,31 @@ class TexDemacro(Stream):
 
     def scan_group(self):
         """Returns group.
+        Its value is a slice of the data, not a copy.
         """
         if not self.legal():
             raise Error("No group to scan.")
-        item = self.item
-        if not (simple_ty == item.type and "{" == item.val):
-            return Group(token_ty, [self.item])
+        data, start = self.data, self.pos
+        if begin_group_code != data.code(start):
+            return Group(token_ty, data[start:start + 1])
         count = 1
-        group = []
-        item = self.next()
-        while count and self.uplegal():
-            if simple_ty == item.type:
-                if "{" == item.val:
-                    count += 1
-                elif "}" == item.val:
-                    count -= 1
-            if count != 0:
-                group.append(item)
-            item = self.next()
+        pos = start + 1
+        while count and pos < len(data):
+            code = data.code(pos)
+            if begin_group_code == code:
+                count += 1
+            elif end_group_code == code:
+                count -= 1
+            pos += 1
+        group = data[start + 1:pos - 1 if not count else pos]
+        self.seek(pos)
         return Group(group_ty, group)
 
+    def seek(self, pos):
+        self.pos = pos
+        if pos < len(self.data):
+            self.item = self.data[pos]
+
     # Command and environment definitions
 
     def scan_command_name(self):
@@ -635,7 +1030,7 @@ class TexDemacro(Stream):
             if not simple_ty == item.type:
                 raise Error("Illegal command or environment definition: "+name)
             numargs = item.val
-            if not pos_digit_re.match(numargs):
+            if not pos_digit_re.fullmatch(numargs):
                 raise Error("%s must be argument number after %s" % (numargs, name))
             numargs = int(numargs)
             self.next()
@@ -751,10 +1146,12 @@ class TexDemacro(Stream):
                 and self.item.val in ["newcommand", "renewcommand"]):
                 command_def = self.scan_command_def()
                 command_defs[command_def.name] = command_def
+                self.def_order.append(("command", command_def.name))
             elif (esc_str_ty == self.item.type and self.item.val
                   in ["newenvironment", "renewenvironment"]):
                 env_def = self.scan_env_def()
                 env_defs[env_def.name] = env_def
+                self.def_order.append(("env", env_def.name))
             else:
                 self.next()
 
@@ -771,9 +1168,13 @@ class TexDemacro(Stream):
 
         args = []
         for i in range(numargs):
-            arg = []
-            if not (simple_ty == self.item.type and "{" == self.item.val):
-                arg = [self.item]
+            code = self.data.code(self.pos)
+            if code in (simple_ty, blank_code) and 1 < len(self.item.val):
+                # an undelimited argument is only the first character of a run
+                arg = self.data.split_first(self.pos)
+                self.item = self.data[self.pos]
+            elif begin_group_code != code:
+                arg = self.data[self.pos:self.pos + 1]
                 self.next()
             else:
                 group = self.scan_group()
@@ -846,7 +1247,7 @@ class TexDemacro(Stream):
             raise Error("No environment rest to scan.")
         count = 1 # We are already within a boundary.
         args = self.scan_args(env_def)
-        body = []
+        body = TokenArray(self.sources)
         while count and self.uplegal():
             old_pos = self.pos
             d = self.test_env_boundary(self.item)
@@ -878,8 +1279,16 @@ class TexDemacro(Stream):
         db_h.close()
 
     def add_defs_str(self, defs_str):
+        if self.shared_defs:
+            command_defs, env_defs = self.defs
+            self.defs = (dict(command_defs), dict(env_defs))
+            self.shared_defs = False
+        # the table no longer describes self.defs
+        self.table = None
         ds = TexDemacro()
         ds.defs = self.defs
+        ds.sources = self.sources
+        ds.def_order = self.def_order
         defs_text = ds.smart_tokenize(defs_str,isatletter=True)
         # changing ds.defs will change self.defs
         ds.scan_defs()
@@ -902,92 +1311,128 @@ class TexDemacro(Stream):
     # (maybe not quite in Knuth order, so avoid tricks!)
 
     def subst_args(self, body, args):
-        out = []
+        out = TokenArray(self.sources)
         pos = 0
         while pos < len(body):
-            item = body[pos]
-            if not (simple_ty == item.type and "#" == item.val):
-                out.append(item)
-                pos += 1
-                continue
-            pos += 1
-            token = body[pos]
-            argnum = token.val
+            param = body.find_code((param_code,), pos)
+            out.extend(body[pos:param])
+            if param == len(body):
+                break
+            pos = param + 1
+            if pos == len(body):
+                raise Error("# is not followed by number.")
+            argnum = body.val(pos)
             if not pos_digit_re.match(argnum):
                 raise Error("# is not followed by number.")
             argnum = int(argnum)
             if argnum > len(args):
                 raise Error("Too large argument number.")
-            arg = args[argnum-1]
-            out += arg
+            out.extend(args[argnum-1])
             pos += 1
         return out
 
     def apply_command_recur(self, command_instance):
         command_defs, env_defs = self.defs
-        name = command_instance.name
-        command_def = command_defs[name]
-
-        args = command_instance.args
-        body = command_def.body
-        result = self.subst_args(body, args)
-        try:
-            result = self.apply_all_recur(result)
-        except Empty_text_error as e:
-            raise Error("apply_all_recur fails on command instance %s: %s, %s" % \
-                  (command_instance.show(), detokenize(e.data), e.message))
-        return result
+        command_def = command_defs[command_instance.name]
+        return self.expand(self.subst_args(command_def.body, command_instance.args))
 
     def apply_env_recur(self, env_instance):
-        command_defs, env_defs = self.defs
-        name = env_instance.name
-        env_def = env_defs[name]
+        return self.expand(self.env_tokens(env_instance))
 
-        begin, end = env_def.begin, env_def.end
-        body, args = env_instance.body, env_instance.args
-        out = self.subst_args(begin, args) + body + self.subst_args(end, args)
-        return self.apply_all_recur(out)
+    def env_tokens(self, env_instance):
+        """The tokens an environment instance stands for, before expansion."""
+        command_defs, env_defs = self.defs
+        env_def = env_defs[env_instance.name]
+        out = self.subst_args(env_def.begin, env_instance.args)
+        out.extend(env_instance.body)
+        out.extend(self.subst_args(env_def.end, env_instance.args))
+        return out
 
     def apply_all_recur(self, data, report=False, return_macros=False):
-        ts = TexDemacro(data=data)
-        ts.defs = self.defs
+        if not len(data):
+            raise Empty_text_error(data, "No text to process.")
+        return self.expand(data, report=report, return_macros=return_macros)
+
+    def expand(self, data, report=False, return_macros=False):
+        """Expand all macros in data.
+        Every expansion gets a frame on an explicit stack, so nesting is
+        limited by max_depth instead of the Python recursion limit, and
+        Budget_error is raised when an output grows over max_output tokens.
+        Expansions of macros without arguments are kept in self.expansions
+        and reused. With return_macros, also return the definitions of the
+        macros used directly in data.
+        """
         command_defs, env_defs = self.defs
-        out, macros = [], []
+        expansions = self.expansions
+        ts = TexDemacro()
+        ts.defs, ts.sources = self.defs, self.sources
+        macros = []
         progress_step = 10000
         progress = progress_step
-        if not ts.legal():
-            raise Empty_text_error(data, "No text to process.")
-        while ts.uplegal():
-            if self.pos > progress:
-                if report:
-                    logging.info(self.pos)
-                progress += progress_step
-            if not ts.item.type in [esc_symb_ty, esc_str_ty]:
-                out.append(ts.item)
-                ts.next()
-                continue
-            if 1 == ts.test_env_boundary(ts.item):
-                old_pos = ts.pos
-                env_name = ts.scan_env_begin()
-                if env_name not in env_defs:
-                    out.extend(ts.data[old_pos : ts.pos])
+
+        def emit(out, tokens):
+            out.extend(tokens)
+            if len(out) > self.max_output:
+                raise Budget_error("Expansion is larger than %d tokens." % (self.max_output))
+
+        # a frame is [tokens, position, output, name of a macro without arguments]
+        root = [data, 0, TokenArray(self.sources), None]
+        stack = [root]
+        while stack:
+            frame = stack[-1]
+            ts.data = frame[0]
+            ts.seek(frame[1])
+            out = frame[2]
+            push = None
+            while ts.uplegal():
+                if report and frame is root and ts.pos > progress:
+                    logging.info(ts.pos)
+                    progress += progress_step
+                if not ts.item.type in [esc_symb_ty, esc_str_ty]:
+                    escape = ts.data.find_code((esc_symb_ty, esc_str_ty), ts.pos)
+                    emit(out, ts.data[ts.pos:escape])
+                    ts.seek(escape)
                     continue
-                else:
+                if 1 == ts.test_env_boundary(ts.item):
+                    old_pos = ts.pos
+                    env_name = ts.scan_env_begin()
+                    if env_name not in env_defs:
+                        emit(out, ts.data[old_pos : ts.pos])
+                        continue
                     env_def = env_defs[env_name]
                     env_instance = ts.scan_env_rest(env_def)
-                    result = ts.apply_env_recur(env_instance)
-                    out.extend(result)
-                    macros.append(env_def.show())
-            elif ts.item.val not in command_defs:
-                out.append(ts.item)
-                ts.next()
-                continue
-            else:
-                command_def = command_defs[ts.item.val]
+                    if frame is root:
+                        macros.append(env_def.show())
+                    push = [ts.env_tokens(env_instance), 0, TokenArray(self.sources), None]
+                    break
+                name = ts.item.val
+                if name not in command_defs:
+                    emit(out, ts.data[ts.pos:ts.pos + 1])
+                    ts.next()
+                    continue
+                command_def = command_defs[name]
+                if frame is root:
+                    macros.append(command_def.show())
+                if 0 == command_def.numargs and name in expansions:
+                    emit(out, expansions[name])
+                    ts.next()
+                    continue
                 command_inst = ts.scan_command(command_def)
-                result = ts.apply_command_recur(command_inst)
-                out.extend(result)
-                macros.append(command_def.show())
+                body = ts.subst_args(command_def.body, command_inst.args)
+                push = [body, 0, TokenArray(self.sources), None if command_def.numargs else name]
+                break
+            frame[1] = ts.pos
+            if push is not None:
+                if len(stack) > self.max_depth:
+                    raise Budget_error("Expansion is nested deeper than %d." % (self.max_depth))
+                stack.append(push)
+                continue
+            stack.pop()
+            if frame[3] is not None:
+                expansions[frame[3]] = frame[2]
+            if stack:
+                emit(stack[-1][2], frame[2])
+        out = root[2]
         return (out, list(dict.fromkeys(macros))) if return_macros else out
 
     # Processing files
@@ -1024,7 +1469,14 @@ class TexDemacro(Stream):
             raise Error("Empty tokenization result.")
         self.reset()
 
-        return self.apply_all_recur(self.data, report=True, return_macros=True)[1]
+        return self.macro_table().find(self.data)
+
+    def macro_table(self):
+        """The MacroTable of self.defs."""
+        if self.table is None:
+            self.table = MacroTable(*self.defs)
+            self.table.order = self.def_order
+        return self.table
 
     def process_if_newer(self, file):
         r"""
@@ -1041,6 +1493,7 @@ class TexDemacro(Stream):
             ts = TexDemacro()
             ts.data = []
             ts.defs = self.defs
+            ts.sources = self.sources
             ts.process_file(file)
         to_add = "\\input{%s}" % (file)
-        return tokenize(to_add)
+        return tokenize(to_add, sources=self.sources)
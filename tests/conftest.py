@@ -0,0 +1,37 @@
+import asyncio
+import threading
+
+import pytest
+from aiohttp import web
+
+
+@pytest.fixture
+def serve():
+    """
+    Start aiohttp applications on localhost, in an event loop of their own,
+    so that both blocking and asyncio clients can talk to them. Returns a
+    function that serves an application and gives its base URL.
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    runners = []
+
+    def call(coro):
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    def start(app):
+        runner = web.AppRunner(app)
+        call(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        call(site.start())
+        runners.append(runner)
+        host, port = runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    yield start
+    for runner in runners:
+        call(runner.cleanup())
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
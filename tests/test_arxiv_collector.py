@@ -0,0 +1,70 @@
+import gzip
+import io
+import tarfile
+import types
+
+import pytest
+
+from src.ArxivCollector import ArxivCollector
+from src.CrawlState import CrawlState
+from src.EprintCache import EprintCache
+
+TEX = rb"\documentclass{article}\begin{document}\begin{tikzpicture}\end{tikzpicture}\end{document}"
+
+
+def tarball(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def collector(tmp_path):
+    """A collector for one subject in tmp_path, without listing or pipeline."""
+    collector = ArxivCollector.__new__(ArxivCollector)
+    collector.app = types.SimpleNamespace(
+        subject="math.NA", eprint_cache=EprintCache(str(tmp_path / "cache"), max_bytes=1 << 20)
+    )
+    collector.keyword = "tikzpicture"
+    collector.collector_path = str(tmp_path)
+    collector.state = CrawlState(str(tmp_path / "state.db"))
+    return collector
+
+
+@pytest.mark.parametrize("eprint, found", [
+    (tarball({"main.tex": TEX}), True),
+    (tarball({"main.tex": b"no figures"}), False),
+    (gzip.compress(TEX), True),
+    (gzip.compress(b"%PDF-1.5 tikzpicture"), False),
+])
+def test_scan_and_extract_tarballs_and_single_files(tmp_path, eprint, found):
+    (tmp_path / "2401.00001.tar.gz").write_bytes(eprint)
+    assert ArxivCollector.scan_source(str(tmp_path), "2401.00001", "tikzpicture") is found
+
+    assert ArxivCollector.tar_source(str(tmp_path), "2401.00001")
+    sources = [path.read_bytes() for path in (tmp_path / "2401.00001").iterdir()]
+    assert (TEX in sources) is found
+
+
+def test_an_unreadable_eprint_is_downloaded_again(collector, tmp_path):
+    downloads = []
+
+    def download(cache_dir, id):
+        downloads.append(id)
+        eprint = b"not an archive" if len(downloads) == 1 else gzip.compress(TEX)
+        (tmp_path / "cache" / f"{id}.tar.gz").write_bytes(eprint)
+        return True
+
+    collector.fetch_source = download
+    scan = collector._tracked("matched", collector.scan_stage)
+    for _ in range(2):
+        assert collector.download_stage("2401.00001")
+        found = scan("2401.00001")
+
+    assert downloads == ["2401.00001", "2401.00001"]
+    assert found
+    assert collector.state.get(["2401.00001"], "tikzpicture")["2401.00001"]["matched"] == 1
@@ -0,0 +1,85 @@
+import asyncio
+import json
+
+from aiohttp import web
+
+from src.ArxivLister import AsyncArxivLister
+
+
+class AtomServer:
+    """
+    An arXiv API stub with `total` results. Later pages answer sooner, so
+    pages complete out of order.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.requests = []
+
+    @staticmethod
+    def id(n):
+        return f"2401.{n:05d}v1"
+
+    async def handle(self, request):
+        start, max_results = int(request.query["start"]), int(request.query["max_results"])
+        self.requests.append((start, max_results))
+        await asyncio.sleep(max(0, 0.3 - start / 400))
+        entries = "".join(
+            f"<entry><id>http://arxiv.org/abs/{self.id(n)}</id><title>Paper {n}</title></entry>"
+            for n in range(start, min(start + max_results, self.total))
+        )
+        feed = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<feed xmlns="http://www.w3.org/2005/Atom" xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">'
+            f"<opensearch:totalResults>{self.total}</opensearch:totalResults>{entries}</feed>"
+        )
+        return web.Response(text=feed, content_type="application/atom+xml")
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/api/query", self.handle)
+        return app
+
+
+def list_ids(serve, server, json_file, max_results, monkeypatch):
+    """Run the lister against server and return (ids, JSON written after each page)."""
+    writes = []
+    write = AsyncArxivLister._write
+
+    def spy(json_file, pages):
+        paper_ids = write(json_file, pages)
+        with open(json_file) as file:
+            writes.append(json.load(file))
+        return paper_ids
+
+    monkeypatch.setattr(AsyncArxivLister, "_write", staticmethod(spy))
+    lister = AsyncArxivLister(page_size=40, interval=0, api_url=serve(server.app()) + "/api/query")
+    return lister.get_list("cat:math.NA", max_results, str(json_file)), writes
+
+
+def test_pages_stop_at_total_results(serve, monkeypatch, tmp_path):
+    server = AtomServer(130)
+    ids, _ = list_ids(serve, server, tmp_path / "ids.json", 1000, monkeypatch)
+
+    assert ids == [AtomServer.id(n) for n in range(130)]
+    assert sorted(server.requests) == [(0, 40), (40, 40), (80, 40), (120, 40)]
+    with open(tmp_path / "ids.json") as file:
+        assert json.load(file) == ids
+
+
+def test_partial_writes_hold_the_leading_pages_in_order(serve, monkeypatch, tmp_path):
+    server = AtomServer(130)
+    ids, writes = list_ids(serve, server, tmp_path / "ids.json", 1000, monkeypatch)
+
+    # pages 120, 80 and 40 complete in that order; until page 40 is in,
+    # only the first page is written
+    assert [len(ids_so_far) for ids_so_far in writes] == [40, 40, 40, 130]
+    assert all(ids[:len(ids_so_far)] == ids_so_far for ids_so_far in writes)
+
+
+def test_max_results_cuts_the_last_page(serve, monkeypatch, tmp_path):
+    server = AtomServer(130)
+    ids, _ = list_ids(serve, server, tmp_path / "ids.json", 50, monkeypatch)
+
+    assert ids == [AtomServer.id(n) for n in range(50)]
+    assert sorted(server.requests) == [(0, 40), (40, 10)]
@@ -0,0 +1,41 @@
+import pytest
+
+from src import demacro
+
+
+# Inputs on which tokenize and tokenize_chars must agree
+TOKENIZE_CASES = [
+    "plain text, blanks  and\ttabs\n\n",
+    "  \t \n\t\t\n   leading and trailing blanks \t ",
+    r"\foo12 \bar{x}[y] \\ \% \{ \, \" \foo@bar",
+    r"% a comment" + "\n   \n" + r"after %% another" + "\n",
+    r"\newcommand{\x}[2]{#1-#2} \x12 ##1 #9x",
+    r"\makeatletter \a@b@ \makeatother \a@b",
+    "trailing escape \\",
+    "escaped newline \\\n and unicode \\é é ß",
+]
+
+
+def expand_runs(tokens):
+    """(type, value) per token, with runs of plain text split into characters."""
+    out = []
+    for token in tokens:
+        if demacro.simple_ty == token.type and 1 < len(token.val):
+            out.extend((demacro.simple_ty, c) for c in token.val)
+        else:
+            out.append((token.type, token.val))
+    return out
+
+
+@pytest.mark.parametrize("text", TOKENIZE_CASES)
+def test_tokenize_matches_tokenize_chars(text):
+    expected = [(token.type, token.val) for token in demacro.tokenize_chars(text)]
+    assert expand_runs(demacro.tokenize(text)) == expected
+
+
+def test_empty_bodies_round_trip_through_find():
+    definitions = [r"\newcommand{\todo}[1]{}", r"\newenvironment{blank}{}{}"]
+    table = demacro.MacroTable.from_str("\n".join(definitions))
+    found = table.find(demacro.tokenize(r"\todo{later} \begin{blank}x\end{blank}"))
+    assert sorted(found) == sorted(definitions)
+    assert demacro.MacroTable.from_str("\n".join(found)).find(demacro.tokenize(r"\todo{x}")) == [definitions[0]]
@@ -0,0 +1,180 @@
+import asyncio
+import gzip
+import json
+import os
+import time
+
+import pytest
+from aiohttp import web
+
+from src import ArxivCollector as collector_module
+from src.ArxivCollector import ArxivCollector
+from src.AsyncFetcher import AsyncFetcher
+from src.PartialDownload import PartialDownload
+
+
+class RangeServer:
+    """
+    An e-print server that honours Range and If-Range. The first full
+    response can be cut short after `cut` bytes, and with `bad_offset` a
+    resumed response starts at the wrong byte. body is sent as it is, under
+    the given Content-Encoding.
+    """
+
+    def __init__(self, body, etag='"v1"', cut=None, bad_offset=False, content_encoding=None):
+        self.body = body
+        self.etag = etag
+        self.cut = cut
+        self.bad_offset = bad_offset
+        self.content_encoding = content_encoding
+        self.requests = []
+
+    async def handle(self, request):
+        self.requests.append({k: request.headers[k] for k in ("Range", "If-Range") if k in request.headers})
+        start, status = 0, 200
+        range_header = request.headers.get("Range")
+        if range_header and request.headers.get("If-Range") == self.etag:
+            start, status = int(range_header.removeprefix("bytes=").rstrip("-")), 206
+        body = self.body[start:]
+
+        response = web.StreamResponse(status=status, headers={"ETag": self.etag})
+        if self.content_encoding:
+            response.headers["Content-Encoding"] = self.content_encoding
+        response.content_length = len(body)
+        if status == 206:
+            first = 0 if self.bad_offset else start
+            response.headers["Content-Range"] = f"bytes {first}-{len(self.body) - 1}/{len(self.body)}"
+        await response.prepare(request)
+        if status == 200 and self.cut is not None:
+            await response.write(body[:self.cut])
+            self.cut = None
+            # let the client consume what was sent before the connection drops
+            await asyncio.sleep(0.2)
+            request.transport.close()
+            return response
+        await response.write(body)
+        await response.write_eof()
+        return response
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/e-print/{id}", self.handle)
+        return app
+
+
+BODY = bytes(range(256)) * 1024
+
+
+@pytest.fixture(params=["requests", "aiohttp"])
+def downloader(request, serve, monkeypatch, tmp_path):
+    """
+    Return a function that points a download of e-print 2401.00001 into
+    tmp_path at a server, through ArxivCollector.download_source or
+    AsyncFetcher.fetch. A download that raises counts as failed.
+    """
+    id = "2401.00001"
+    fetcher = AsyncFetcher(chunk_size=4096) if request.param == "aiohttp" else None
+
+    def make(server):
+        base_url = serve(server.app()) + "/e-print/"
+        monkeypatch.setattr(collector_module, "EPRINT_URL", base_url)
+
+        def download():
+            try:
+                if fetcher is None:
+                    return ArxivCollector.download_source(str(tmp_path), id)
+                return fetcher._call(fetcher.fetch(base_url + id, str(tmp_path / f"{id}.tar.gz")))
+            except Exception:
+                return False
+
+        return download
+
+    yield make
+    if fetcher is not None:
+        fetcher.close()
+
+
+def test_resumes_an_interrupted_download(downloader, tmp_path):
+    server = RangeServer(BODY, cut=100_000)
+    download = downloader(server)
+    target = tmp_path / "2401.00001.tar.gz"
+
+    assert not download()
+    assert not target.exists()
+    received = os.path.getsize(str(target) + ".part")
+    assert 0 < received < len(BODY)
+    with open(str(target) + ".part.json") as file:
+        assert json.load(file) == {"length": len(BODY), "etag": '"v1"', "last_modified": None}
+
+    assert download()
+    assert target.read_bytes() == BODY
+    assert server.requests[-1] == {"Range": f"bytes={received}-", "If-Range": '"v1"'}
+    assert not os.path.exists(str(target) + ".part")
+    assert not os.path.exists(str(target) + ".part.json")
+
+
+def test_starts_over_when_the_eprint_changed(downloader, tmp_path):
+    server = RangeServer(BODY, cut=100_000)
+    download = downloader(server)
+    assert not download()
+
+    server.body, server.etag = BODY[::-1], '"v2"'
+    assert download()
+    assert (tmp_path / "2401.00001.tar.gz").read_bytes() == BODY[::-1]
+    assert server.requests[-1]["If-Range"] == '"v1"'
+
+
+def test_restarts_once_on_a_misplaced_range(downloader, tmp_path):
+    server = RangeServer(BODY, cut=100_000, bad_offset=True)
+    download = downloader(server)
+    assert not download()
+
+    assert download()
+    assert (tmp_path / "2401.00001.tar.gz").read_bytes() == BODY
+    # the resumed reply started at byte 0, so the part file was dropped
+    # and the e-print fetched again without a Range
+    assert "Range" in server.requests[-2]
+    assert server.requests[-1] == {}
+
+
+def test_an_overshooting_part_file_is_discarded(tmp_path):
+    target = str(tmp_path / "paper.tar.gz")
+    download = PartialDownload(target)
+    assert download.begin(200, {"Content-Length": "10", "ETag": '"v1"'}) == "wb"
+    with open(download.part_file, "wb") as file:
+        file.write(b"x" * 12)
+
+    assert not download.finish()
+    assert not os.path.exists(download.part_file)
+    assert not os.path.exists(download.journal_file)
+    assert PartialDownload(target).request_headers() == {}
+
+
+def test_encoded_eprints_are_stored_as_sent(downloader, tmp_path):
+    body = gzip.compress(BODY)
+    server = RangeServer(body, cut=len(body) // 2, content_encoding="gzip")
+    download = downloader(server)
+    assert not download()
+
+    assert download()
+    assert "Range" in server.requests[-1]
+    assert (tmp_path / "2401.00001.tar.gz").read_bytes() == body
+
+
+def test_a_stalled_download_times_out(serve, monkeypatch, tmp_path):
+    async def stall(request):
+        response = web.StreamResponse(headers={"ETag": '"v1"'})
+        response.content_length = len(BODY)
+        await response.prepare(request)
+        await response.write(BODY[:1000])
+        await asyncio.sleep(2)
+        return response
+
+    app = web.Application()
+    app.router.add_get("/e-print/{id}", stall)
+    monkeypatch.setattr(collector_module, "EPRINT_URL", serve(app) + "/e-print/")
+
+    start = time.monotonic()
+    with pytest.raises(Exception):
+        ArxivCollector.download_source(str(tmp_path), "2401.00001", timeout=(5, 0.3))
+    assert time.monotonic() - start < 2